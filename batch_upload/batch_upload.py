@@ -1,3 +1,4 @@
+import os
 import argparse
 import logging
 import logging.config
@@ -14,7 +15,9 @@ from retrievers.csv_data_retriever import CSVDataRetriever
 from retrievers.sql_data_retriever import SQLDataRetriever
 from extractors.loss_set import LossSetExtractor
 from extractors.layer import LayerExtractor
-from uploaders.are_uploader import BatchUploader
+from uploaders.are_uploader import BatchUploader, UPLOAD_THREADS
+from uploaders.resource_cache import resource_cache
+from uploaders.http_session import configure_session, log_pool_statistics
 
 logging.config.fileConfig("logging.ini")
 LOG = logging.getLogger(__name__)
@@ -53,6 +56,8 @@ def construct_argument_parser():
 
 
 def set_and_check_credentials(url, username, password):
+    # One pooled connection per upload thread
+    configure_session(max(UPLOAD_THREADS, os.cpu_count() or 1))
     try:
         analyzere.base_url = url
         analyzere.username = username
@@ -85,6 +90,11 @@ if __name__ == "__main__":
     # This will simply throw if the credentials don't work.
     set_and_check_credentials(url, username, password)
 
+    # Cache reference resources on disk if configured
+    cache_config = getattr(config, "cache", None)
+    if cache_config is not None:
+        resource_cache.configure(cache_config.directory, cache_config.ttl)
+
     # Initialze the retriever
     retriever = retrievers[args.source](args, config)
 
@@ -107,3 +117,4 @@ if __name__ == "__main__":
         layer_extractor, loss_set_extractor, args.batch_id, config
     )
     batch_uploader.batch_upload()
+    log_pool_statistics()
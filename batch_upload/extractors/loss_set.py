@@ -105,6 +105,22 @@ class LossSetExtractor:
         # Replace the column names in the loss dataframe
         self.loss_df = self.loss_df.rename(columns=column_mapper)
 
+    def get_column_precision(self):
+        """
+        Returns the number of decimals that loss set columns are rounded to
+        when uploaded, keyed by Analyze Re column name. Columns without a
+        configured precision are uploaded with full precision.
+        """
+        precision_config = getattr(self.config, "loss_set_precision", None)
+        if precision_config is None:
+            return {}
+
+        return {
+            getattr(ARE_TARGET_COLUMNS, column): int(value)
+            for column, value in precision_config._asdict().items()
+            if column in ARE_TARGET_COLUMNS._fields and value.strip()
+        }
+
     def _transform_loss_sets(self):
         self.check_required_columns()
         self.check_loss_content()
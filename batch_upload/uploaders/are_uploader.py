@@ -2,7 +2,7 @@ from re import A
 import sys
 import csv
 from concurrent.futures import ThreadPoolExecutor
-from io import StringIO
+from io import BytesIO
 
 from analyzere import (
     LossSet,
@@ -21,16 +21,21 @@ from extractors.layer import (
     get_int,
 )
 from extractors.loss_set import LossSetExtractor
+from uploaders.csv_renderer import SharedMemoryCSVRenderer
+from uploaders.status_verifier import LossSetStatusVerifier
+from uploaders.resource_cache import resource_cache
 
 import logging
 
 LOG = logging.getLogger()
 
+# Number of layers that are created and uploaded concurrently
+UPLOAD_THREADS = 4
+
 
 class DataToCSVIO:
-    def __init__(self, data):
-        self.csv_io = StringIO()
-        data.to_csv(self.csv_io, index=False)
+    def __init__(self, data, renderer):
+        self.csv_io = BytesIO(renderer.render(data))
 
     def __enter__(self):
         self.csv_io.seek(0)
@@ -55,7 +60,7 @@ class BatchUploader:
         return LossSet(
             type="ELTLossSet",
             description=f"Loss Set for Layer {layer_id}",
-            event_catalogs=self.analysis_profile.event_catalogs,
+            event_catalogs=self.event_catalogs,
             currency=currency,
             loss_type=self.config.defaults.loss_perspective,
             meta_data=dict(
@@ -67,7 +72,7 @@ class BatchUploader:
         return LossSet(
             type="YELTLossSet",
             description=f"Loss Set for Layer {layer_id}",
-            event_catalogs=self.analysis_profile.event_catalogs,
+            event_catalogs=self.event_catalogs,
             currency=currency,
             loss_type=self.config.defaults.loss_perspective,
             start_date=self.config.defaults.start_date,
@@ -81,7 +86,7 @@ class BatchUploader:
         return LossSet(
             type="YLTLossSet",
             description=f"Loss Set for Layer {layer_id}",
-            event_catalogs=self.analysis_profile.event_catalogs,
+            event_catalogs=self.event_catalogs,
             currency=currency,
             loss_type=self.config.defaults.loss_perspective,
             start_date=self.config.defaults.start_date,
@@ -110,7 +115,7 @@ class BatchUploader:
         loss_set.save()
 
         # Convert data to CSV file stream
-        with DataToCSVIO(data) as f:
+        with DataToCSVIO(data, self.csv_renderer) as f:
             loss_set.upload_data(f)
 
         return loss_set
@@ -336,8 +341,20 @@ class BatchUploader:
                 layer.description,
             )
 
-        with ThreadPoolExecutor(4) as pool:
-            results = pool.map(create_and_upload, layers)
+        # Loss set rendering is offloaded to worker processes, so use
+        # enough threads to keep all of them busy.
+        threads = max(UPLOAD_THREADS, self.csv_renderer.max_workers)
+        with self.csv_renderer, ThreadPoolExecutor(threads) as pool:
+            results = list(pool.map(create_and_upload, layers))
+
+        # Wait for the server to finish processing all uploaded loss sets
+        statuses = self.status_verifier.verify(
+            [
+                are_loss_set_uuid
+                for _, _, are_loss_set_uuids, _ in results
+                for are_loss_set_uuid in are_loss_set_uuids
+            ]
+        )
 
         with open("layer_mapping.csv", "w", newline="\n") as out:
             writer = csv.writer(out)
@@ -348,6 +365,7 @@ class BatchUploader:
                     "ARE Layer UUID",
                     "ARE Loss Set UUID",
                     "ARE Layer Description",
+                    "ARE Loss Set Status",
                 ]
             )
             writer.writerows(
@@ -359,6 +377,10 @@ class BatchUploader:
                         are_layer_uuid,
                         ";".join(are_loss_set_uuids),
                         description,
+                        ";".join(
+                            statuses.get(uuid, (None, None))[0] or "unknown"
+                            for uuid in are_loss_set_uuids
+                        ),
                     )
                     for (
                         layer_id,
@@ -380,7 +402,14 @@ class BatchUploader:
         self.loss_ext = loss_ext
         self.batch_id = batch_id
         self.config = config
-        self.analysis_profile = AnalysisProfile.retrieve(
-            config.defaults.analysis_profile_uuid
+        self.analysis_profile = resource_cache.retrieve(
+            AnalysisProfile, config.defaults.analysis_profile_uuid
         )
+        # The catalogs are shared by all loss sets. They are only sent as
+        # references and never have to be resolved.
+        self.event_catalogs = list(self.analysis_profile.event_catalogs)
         self.layer_columns = self.config.layer_columns
+        self.csv_renderer = SharedMemoryCSVRenderer(
+            self.loss_ext.get_column_precision()
+        )
+        self.status_verifier = LossSetStatusVerifier()
@@ -0,0 +1,124 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from uploaders.csv_encoder import encode_csv
+
+import logging
+
+LOG = logging.getLogger()
+
+
+def _attach_columns(shm, layout):
+    """
+    Returns a dictionary of column name to NumPy array views onto the
+    shared memory block according to the given layout.
+    """
+    return {
+        name: np.ndarray(
+            (length,), dtype=np.dtype(dtype), buffer=shm.buf, offset=offset
+        )
+        for name, dtype, offset, length in layout
+    }
+
+
+def _render_shared_columns(shm_name, layout, precision):
+    """
+    Worker entry point: attaches to the shared memory block holding the
+    loss set columns and renders them as an encoded CSV byte buffer.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        columns = _attach_columns(shm, layout)
+        buffer = encode_csv(columns, precision)
+        # Release the views before closing, otherwise the shared memory
+        # buffer can't be unmapped.
+        del columns
+        return buffer
+    finally:
+        shm.close()
+
+
+def _format_fixed(value, decimals):
+    # Adding zero drops the sign of values that round to zero, as
+    # encode_csv does
+    return f"{round(value, decimals) + 0.0:.{decimals}f}"
+
+
+class SharedMemoryCSVRenderer:
+    """
+    Renders loss set DataFrames into CSV byte buffers in a pool of worker
+    processes.
+
+    The columns of a loss set are copied into a single shared memory block
+    and only the block's name and column layout are sent to the worker, so
+    that DataFrames never have to be pickled. Loss sets with non-numeric
+    columns can't be shared this way and are rendered in-process instead.
+
+    Floating point columns are rounded to the number of decimals configured
+    for the column in precision, or written with full precision otherwise.
+    """
+
+    def render(self, data):
+        if self.pool is None or not all(
+            dtype.kind in "biuf" for dtype in data.dtypes
+        ):
+            return self._format_floats(data).to_csv(index=False).encode()
+
+        arrays = [
+            (name, np.ascontiguousarray(data[name].to_numpy()))
+            for name in data.columns
+        ]
+
+        layout = []
+        offset = 0
+        for name, array in arrays:
+            layout.append((name, array.dtype.str, offset, len(array)))
+            # Keep every column aligned to 8 bytes within the block
+            offset += -(-array.nbytes // 8) * 8
+
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        try:
+            views = _attach_columns(shm, layout)
+            for name, array in arrays:
+                views[name][:] = array
+            del views
+            return self.pool.submit(
+                _render_shared_columns, shm.name, layout, self.precision
+            ).result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _format_floats(self, data):
+        # Rounds the floating point columns with a configured precision
+        # like encode_csv does, missing values are left empty
+        formatted = data.copy()
+        for name, decimals in self.precision.items():
+            if name in data.columns and data[name].dtype.kind == "f":
+                column = data[name]
+                formatted[name] = column.map(
+                    partial(_format_fixed, decimals=decimals)
+                ).where(column.notna())
+        return formatted
+
+    def __enter__(self):
+        # Workers are started from the upload threads, spawned processes
+        # don't inherit the locks those threads hold
+        self.pool = ProcessPoolExecutor(
+            self.max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        return self
+
+    def __exit__(self, *args):
+        self.pool.shutdown()
+        self.pool = None
+
+    def __init__(self, precision=None, max_workers=None):
+        self.precision = precision or {}
+        self.max_workers = max_workers or os.cpu_count()
+        self.pool = None
@@ -0,0 +1,104 @@
+import socket
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from analyzere import requestor
+
+LOG = logging.getLogger()
+
+# Number of connections kept open to the server, enough for all upload
+# threads and the status checks running alongside them
+POOL_MAXSIZE = 32
+
+# Uploads of large loss sets leave other connections idle for minutes,
+# keep them from being dropped by firewalls and load balancers
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+]
+for option, value in [("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15)]:
+    if hasattr(socket, option):
+        SOCKET_OPTIONS.append(
+            (socket.IPPROTO_TCP, getattr(socket, option), value)
+        )
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    Adapter for the pooled batch upload session. Connections send TCP
+    keep-alive probes and the adapter counts how many connections the
+    pool had to open, which is logged at the end of the batch.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+    def statistics(self):
+        sent = opened = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return sent, opened
+
+
+class _SessionRequests:
+    # The pinned analyzere bindings call requests.request() directly,
+    # which opens a new connection for every request. This forwards those
+    # calls to the pooled session.
+    def __init__(self, session):
+        self._session = session
+
+    def request(self, method, url, **kwargs):
+        return self._session.request(method, url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+_session = None
+_adapter = None
+
+
+def configure_session(pool_maxsize=POOL_MAXSIZE):
+    """
+    Routes every request of the analyzere bindings, including loss data
+    uploads, through one keep-alive session. pool_maxsize should cover the
+    upload threads of the batch.
+    """
+    global _session, _adapter
+
+    _adapter = KeepAliveAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    _session = requests.Session()
+    _session.mount("https://", _adapter)
+    _session.mount("http://", _adapter)
+
+    if hasattr(requestor, "session"):
+        requestor.session = _session
+    else:
+        requestor.requests = _SessionRequests(_session)
+    LOG.debug(f"Configured HTTP connection pool of {pool_maxsize}")
+    return _session
+
+
+def pool_statistics():
+    """
+    Counts the requests of the batch, split into those that reused a
+    pooled connection (hits) and those that opened one (misses).
+    """
+    sent, opened = _adapter.statistics() if _adapter else (0, 0)
+    return {"requests": sent, "hits": sent - opened, "misses": opened}
+
+
+def log_pool_statistics():
+    statistics = pool_statistics()
+    LOG.info(
+        f"HTTP connection pool: {statistics['requests']} requests, "
+        f"{statistics['hits']} reused connections, "
+        f"{statistics['misses']} new connections"
+    )
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+
+import analyzere
+from analyzere import utils
+from analyzere.base_resources import convert_to_analyzere_object
+from analyzere.requestor import request_raw
+
+LOG = logging.getLogger()
+
+
+class ResourceCache:
+    """
+    Cache for the reference resources a batch is uploaded against, such as
+    the Analysis Profile whose event catalogs every loss set refers to.
+    They don't change once created.
+
+    Batches are usually uploaded one after another against the same
+    profile. With a cache directory in the [cache] section of the config,
+    the server responses are kept on disk, so consecutive batches skip the
+    retrieval until the responses are older than the TTL. Each call
+    returns a new resource object.
+    """
+
+    def __init__(self, directory=None, ttl=24 * 60 * 60):
+        self.directory = directory
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def configure(self, directory=None, ttl=None):
+        self.directory = directory or None
+        if ttl is not None:
+            self.ttl = float(ttl)
+
+    def _disk_path(self, collection, id_):
+        # Batches may be uploaded to several servers from one machine
+        server = hashlib.sha1(analyzere.base_url.encode()).hexdigest()[:12]
+        return os.path.join(self.directory, server, collection, f"{id_}.json")
+
+    def _read_disk(self, collection, id_):
+        if not self.directory:
+            return None
+        path = self._disk_path(collection, id_)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as cached_file:
+                return cached_file.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, collection, id_, text):
+        if not self.directory:
+            return
+        path = self._disk_path(collection, id_)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as cached_file:
+                cached_file.write(text)
+            os.replace(temp_path, path)
+        except OSError as e:
+            LOG.warning(f"Unable to cache {collection} {id_}: {e}")
+
+    def _fetch(self, resource_class, id_):
+        collection = resource_class._get_collection_name()
+        text = self._read_disk(collection, id_)
+        if text is None:
+            text = request_raw(
+                "get",
+                resource_class._get_path(id_),
+                headers={"accept": "application/json"},
+            ).text
+            self._write_disk(collection, id_, text)
+        else:
+            LOG.debug(f"Loaded {collection} {id_} from disk cache")
+        return json.loads(text, cls=utils.DateTimeDecoder)
+
+    def retrieve(self, resource_class, id_):
+        key = (resource_class._get_collection_name(), id_)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        # Concurrent callers wait for a single fetch of the resource
+        with lock:
+            if key not in self._entries:
+                self._entries[key] = self._fetch(resource_class, id_)
+
+        return convert_to_analyzere_object(self._entries[key], resource_class)
+
+
+resource_cache = ResourceCache()
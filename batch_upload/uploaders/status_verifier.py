@@ -0,0 +1,100 @@
+import time
+
+from analyzere import LossSet
+
+import logging
+
+LOG = logging.getLogger()
+
+PROCESSING_SUCCEEDED = "processing_succeeded"
+PROCESSING_FAILED = "processing_failed"
+FINAL_STATUSES = (PROCESSING_SUCCEEDED, PROCESSING_FAILED)
+
+
+def _pages(ids, page_size):
+    for start in range(0, len(ids), page_size):
+        yield ids[start : start + page_size]
+
+
+class LossSetStatusVerifier:
+    """
+    Waits for the server-side processing of uploaded loss sets to finish.
+
+    Rather than reloading every loss set individually, the statuses of all
+    pending loss sets are retrieved in pages of list requests filtered by
+    ID. The poll interval starts short and grows while no loss set finishes
+    processing, and is reset whenever processing makes progress.
+    """
+
+    def poll(self, ids):
+        """
+        Retrieves the current status and status message of the loss sets
+        with the given IDs.
+        """
+        statuses = {}
+        for page in _pages(ids, self.page_size):
+            loss_sets = LossSet.list(ids=",".join(page), limit=len(page))
+            for loss_set in loss_sets:
+                statuses[loss_set.id] = (
+                    getattr(loss_set, "status", None),
+                    getattr(loss_set, "status_message", None),
+                )
+        return statuses
+
+    def verify(self, ids):
+        """
+        Polls the loss sets with the given IDs until all of them have
+        finished processing or the timeout is reached. Returns the last
+        known status and status message of each loss set.
+        """
+        statuses = {}
+        pending = sorted(set(ids))
+        interval = self.min_interval
+        deadline = time.monotonic() + self.timeout
+
+        LOG.info(f"Verifying processing status of {len(pending)} loss sets")
+        while pending:
+            statuses.update(self.poll(pending))
+            remaining = [
+                id_
+                for id_ in pending
+                if statuses.get(id_, (None,))[0] not in FINAL_STATUSES
+            ]
+
+            if not remaining:
+                break
+            if time.monotonic() + interval > deadline:
+                LOG.warning(
+                    f"Timed out waiting for {len(remaining)} loss sets to "
+                    f"finish processing."
+                )
+                break
+
+            # Back off while nothing finishes, otherwise keep polling at
+            # the shortest interval.
+            if len(remaining) < len(pending):
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+            pending = remaining
+            time.sleep(interval)
+
+        for id_, (status, message) in statuses.items():
+            if status == PROCESSING_FAILED:
+                LOG.error(f"Loss set {id_} failed processing: {message}")
+
+        return statuses
+
+    def __init__(
+        self,
+        page_size=100,
+        min_interval=1.0,
+        max_interval=30.0,
+        backoff=2.0,
+        timeout=3600.0,
+    ):
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
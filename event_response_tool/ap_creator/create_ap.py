@@ -1,16 +1,36 @@
+import io
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from math import ceil
+from functools import partial
 
 import analyzere
+from analyzere import errors as are_errors
+import numpy as np
 import pytz
 
 from utils.alert import Alert as alert
-from utils.file_handler import find_column
-from utils.are_resources import check_resource_upload_status
+from utils.csv_encoder import encode_csv
+from utils.file_handler import find_column, ChunkedByteStream
+from utils.are_resources import (
+    FINAL_STATUSES,
+    check_resource_upload_status,
+    list_resources,
+    then,
+)
+from utils.task_graph import TaskGraph
+from utils.resource_cache import resource_cache
+from ap_creator.registry import AnalysisProfileRegistry
 
 logger = logging.getLogger()
 
+# Number of rows generated at a time for catalogs and simulations that are
+# streamed to the server
+ROWS_PER_CHUNK = 1_000_000
+# Number of loss filters created concurrently
+LOSS_FILTER_THREADS = 16
+
 
 class AnalysisProfileCreator:
     def __init__(
@@ -34,15 +54,27 @@ class AnalysisProfileCreator:
         self.analysis_profile_description = analysis_profile_description
         self.old_analysis_profile_uuid = old_analysis_profile_uuid
         self.simulation_start_date = simulation_start_date
+        self.registry = AnalysisProfileRegistry(
+            config.get("ap_creator", "analysis_profile_registry", fallback="")
+        )
+
+    def generate_catalog_data(self):
+        # Generate the catalog rows lazily, a chunk of events at a time
+        yield b"EventId,Rate,Sequence\n"
+        for start in range(1, self.total_num_of_events + 1, ROWS_PER_CHUNK):
+            stop = min(start + ROWS_PER_CHUNK, self.total_num_of_events + 1)
+            event_ids = np.arange(start, stop)
+            yield encode_csv(
+                {
+                    "EventId": event_ids,
+                    "Rate": np.ones(len(event_ids), dtype=np.int64),
+                    "Sequence": event_ids,
+                },
+                header=False,
+            )
 
     def create_catalog(self):
-        events_data = "\n".join(
-            [
-                "%s,1,%s" % (i, i)
-                for i in range(1, self.total_num_of_events + 1)
-            ]
-        )
-        catalog_data = """EventId,Rate,Sequence\n""" + events_data
+        catalog_data = ChunkedByteStream(self.generate_catalog_data())
 
         try:
             catalog = analyzere.EventCatalog(
@@ -54,10 +86,14 @@ class AnalysisProfileCreator:
 
             catalog.save()
             catalog.upload_data(catalog_data)
-            check_resource_upload_status(catalog)
+            processed = check_resource_upload_status(catalog)
         except Exception as e:
             alert.exception(f"Exception occured while creating catalog: {e}")
-        else:
+        finally:
+            # Stops generating catalog data if the upload was aborted
+            catalog_data.close()
+
+        def report(catalog):
             if catalog.status == "processing_succeeded":
                 alert.info(
                     f"Event Catalog {catalog.id} has been created successfully",
@@ -68,6 +104,10 @@ class AnalysisProfileCreator:
                 )
             return catalog
 
+        # Returns a future of the catalog instead of waiting for it to be
+        # processed
+        return then(processed, report)
+
     def upload_simulation(
         self, event_catalogs, start_date, trial_count, simulation_data
     ):
@@ -81,12 +121,16 @@ class AnalysisProfileCreator:
             )
             simulation.save()
             simulation.upload_data(simulation_data)
-            check_resource_upload_status(simulation)
+            processed = check_resource_upload_status(simulation)
         except Exception as e:
             alert.exception(
                 f"Exception occured while uploading simulation: {e}"
             )
-        else:
+        finally:
+            # Stops generating simulation data if the upload was aborted
+            simulation_data.close()
+
+        def report(simulation):
             if simulation.status == "processing_succeeded":
                 alert.info(
                     f"Simulation {simulation.id} has been created successfully"
@@ -97,6 +141,10 @@ class AnalysisProfileCreator:
                 )
             return simulation
 
+        # Returns a future of the simulation instead of waiting for it to
+        # be processed
+        return then(processed, report)
+
     def build_weighted_simulation_data(self):
         alert.debug("Building weighted simulation data")
 
@@ -106,37 +154,51 @@ class AnalysisProfileCreator:
         weight_column = find_column(
             "weight", self.event_weights_df.columns.tolist()
         )
-        events = self.event_weights_df[event_column].to_list()
-        weights = self.event_weights_df[weight_column].to_list()
+        events = self.event_weights_df[event_column].to_numpy()
+        weights = self.event_weights_df[weight_column].to_numpy()
 
+        # Every event occurs in ceil(max_trials * weight) consecutive trials
         max_trials = self.trial_count
-        trial_count_by_event = [ceil(max_trials * w) for w in weights]
-        trial_id = 1
-
-        simulation_data = """TrialId,EventId,Day\n"""
-
-        for event_id, trial_count in zip(events, trial_count_by_event):
-            for _ in range(0, trial_count):
-                simulation_data += "%s,%s,%s\n" % (trial_id, event_id, 1)
-                trial_id += 1
+        trial_count_by_event = np.ceil(max_trials * weights).astype(np.int64)
+        trial_count_by_event = trial_count_by_event.clip(min=0)
+        total_trials = int(trial_count_by_event.sum())
+
+        simulation_data = encode_csv(
+            {
+                "TrialId": np.arange(1, total_trials + 1),
+                "EventId": np.repeat(events, trial_count_by_event),
+                "Day": np.ones(total_trials, dtype=np.int64),
+            }
+        )
 
-        return simulation_data, sum(trial_count_by_event)
+        return io.BytesIO(simulation_data), total_trials
+
+    def generate_simulation_data(self, total_trials):
+        # Every event occurs in trial_count consecutive trials. Generate
+        # the rows lazily, a chunk of trials at a time.
+        yield b"TrialId,EventId,Day\n"
+        for start in range(1, total_trials + 1, ROWS_PER_CHUNK):
+            stop = min(start + ROWS_PER_CHUNK, total_trials + 1)
+            trial_ids = np.arange(start, stop)
+            yield encode_csv(
+                {
+                    "TrialId": trial_ids,
+                    "EventId": (trial_ids - 1) // self.trial_count + 1,
+                    "Day": np.ones(len(trial_ids), dtype=np.int64),
+                },
+                header=False,
+            )
 
     def build_simulation_data(self):
         alert.debug("Building simulation data")
 
-        events = [i for i in range(1, self.total_num_of_events + 1)]
-        trial_id = 1
-
-        simulation_data = """TrialId,EventId,Day\n"""
-        max_trials = self.trial_count
-
-        for event_id in events:
-            for _ in range(0, max_trials):
-                simulation_data += "%s,%s,%s\n" % (trial_id, event_id, 1)
-                trial_id += 1
+        total_trials = self.total_num_of_events * self.trial_count
+        simulation_data = ChunkedByteStream(
+            self.generate_simulation_data(total_trials)
+        )
 
-        return simulation_data, trial_id
+        # Trial count of the simulation, the id following the last trial
+        return simulation_data, total_trials + 1
 
     def create_simulation(self, catalogs, start_date, weighted=False):
         simulation_data = None
@@ -159,20 +221,64 @@ class AnalysisProfileCreator:
             simulation_data=simulation_data,
         )
 
-        return simulation
+        return simulation.result()
+
+    def find_event_loss_filters(self, event_ids):
+        # Look up the event filters registered for this server by their
+        # UUIDs, so that only the filters of the given events are fetched.
+        # Filters that were deleted or changed since are left out.
+        registered = self.registry.lookup_loss_filters(analyzere.base_url)
+        uuids = {
+            event_id: registered[event_id]
+            for event_id in event_ids
+            if event_id in registered
+        }
+        existing = list_resources(analyzere.LossFilter, uuids.values())
+
+        event_filters = {}
+        for event_id, uuid in uuids.items():
+            loss_filter = existing.get(uuid)
+            if (
+                loss_filter is not None
+                and getattr(loss_filter, "type", None) == "AnyOfFilter"
+                and getattr(loss_filter, "attribute", None) == "EventId"
+                and list(getattr(loss_filter, "values", None) or [])
+                == [event_id]
+            ):
+                event_filters[event_id] = loss_filter
+        return event_filters
+
+    def create_loss_filter(self, event_id):
+        return analyzere.LossFilter(
+            type="AnyOfFilter",
+            name="Event %s" % (event_id),
+            description="Event %s" % (event_id),
+            attribute="EventId",
+            values=[event_id],
+        ).save()
 
     def create_loss_filters(self):
-        loss_filters = [
-            analyzere.LossFilter(
-                type="AnyOfFilter",
-                name="Event %s" % (i),
-                description="Event %s" % (i),
-                attribute="EventId",
-                values=[i],
-            ).save()
-            for i in range(1, self.total_num_of_events + 1)
-        ]
-        alert.info(f"Created {len(loss_filters)} Loss Filters successfully")
+        # Reuse the event filters that already exist on the server and
+        # only create the missing ones.
+        event_ids = range(1, self.total_num_of_events + 1)
+        event_filters = self.find_event_loss_filters(event_ids)
+        missing = [i for i in event_ids if i not in event_filters]
+
+        with ThreadPoolExecutor(LOSS_FILTER_THREADS) as executor:
+            created = dict(
+                zip(missing, executor.map(self.create_loss_filter, missing))
+            )
+        event_filters.update(created)
+        self.registry.register_loss_filters(
+            analyzere.base_url,
+            {event_id: f.id for event_id, f in created.items()},
+        )
+
+        loss_filters = [event_filters[i] for i in event_ids]
+        alert.info(
+            f"Created {len(missing)} and reused "
+            f"{len(loss_filters) - len(missing)} Loss Filters successfully"
+        )
 
         return loss_filters
 
@@ -185,7 +291,9 @@ class AnalysisProfileCreator:
         try:
             if fx_profile_uuid:
                 alert.info(f"Fetching FX Profile {fx_profile_uuid}")
-                return analyzere.ExchangeRateProfile.retrieve(fx_profile_uuid)
+                return resource_cache.retrieve(
+                    analyzere.ExchangeRateProfile, fx_profile_uuid
+                )
             else:
                 fx_profile = analyzere.ExchangeRateProfile.list(
                     ordering="-created", limit=1
@@ -203,8 +311,8 @@ class AnalysisProfileCreator:
             alert.info(
                 f"Updating Analysis Profile {self.old_analysis_profile_uuid} with new Simulation"
             )
-            old_ap = analyzere.AnalysisProfile.retrieve(
-                self.old_analysis_profile_uuid
+            old_ap = resource_cache.retrieve(
+                analyzere.AnalysisProfile, self.old_analysis_profile_uuid
             )
             del old_ap.id
             old_ap.description = self.analysis_profile_description
@@ -218,7 +326,7 @@ class AnalysisProfileCreator:
             )
             old_ap.simulation = new_simulation
             new_ap = old_ap.save()
-            check_resource_upload_status(new_ap)
+            check_resource_upload_status(new_ap).result()
         except Exception as e:
             alert.exception(
                 f"Exception occured while updating Analysis Profile {self.old_analysis_profile_uuid}: {e}"
@@ -234,24 +342,121 @@ class AnalysisProfileCreator:
                     f"Analysis Profile {new_ap.id} was created, but failed while processing. {new_ap.status_message}"
                 )
 
-    def create_analysis_profile(self):
-        # Create a new specialized Analysis Profile for event response
+    def upload_catalog_simulation(self, catalog, simulation_data):
+        simulation_data, trial_count = simulation_data
+        return self.upload_simulation(
+            event_catalogs=[catalog],
+            start_date=self.simulation_start_date,
+            trial_count=trial_count,
+            simulation_data=simulation_data,
+        )
+
+    def save_analysis_profile(
+        self, catalog, simulation, loss_filters, fx_profile
+    ):
+        analysis_profile = analyzere.AnalysisProfile()
+        analysis_profile.event_catalogs = [catalog]
+        analysis_profile.simulation = simulation
+        analysis_profile.description = self.analysis_profile_description
+        analysis_profile.loss_filters = loss_filters
+        analysis_profile.exchange_rate_profile = fx_profile
+        analysis_profile.save()
+        return check_resource_upload_status(analysis_profile)
+
+    def analysis_profile_key(self, fx_profile):
+        # Convolution Analysis Profiles are fully determined by these
+        # parameters, so profiles built from the same ones on the same
+        # server are reusable.
+        return json.dumps(
+            {
+                "server": analyzere.base_url,
+                "total_number_of_events": self.total_num_of_events,
+                "trial_count": self.trial_count,
+                "simulation_start_date": self.simulation_start_date.strftime(
+                    "%Y-%m-%dT%H:%M:%S"
+                ),
+                "fx_profile": fx_profile.id,
+            },
+            sort_keys=True,
+        )
+
+    def find_registered_analysis_profile(self, key):
+        analysis_profile_uuid = self.registry.lookup(key)
+        if not analysis_profile_uuid:
+            return None
+
+        # Make sure the registered profile is still usable. Only profiles
+        # that are gone or failed are forgotten, other errors may be
+        # transient.
         try:
-            catalog = self.create_catalog()
-            simulation = self.create_simulation(
-                [catalog], self.simulation_start_date
+            analysis_profile = analyzere.AnalysisProfile.retrieve(
+                analysis_profile_uuid
+            )
+            if analysis_profile.status not in FINAL_STATUSES:
+                check_resource_upload_status(analysis_profile).result()
+        except are_errors.InvalidRequestError as e:
+            if e.http_status != 404:
+                alert.exception(
+                    f"Exception occured while retrieving registered Analysis Profile {analysis_profile_uuid}: {e}"
+                )
+            alert.warning(
+                f"Registered Analysis Profile {analysis_profile_uuid} no longer exists, creating a new one"
             )
+            self.registry.remove(key)
+            return None
+        except Exception as e:
+            alert.exception(
+                f"Exception occured while retrieving registered Analysis Profile {analysis_profile_uuid}: {e}"
+            )
+
+        if analysis_profile.status == "processing_failed":
+            alert.warning(
+                f"Registered Analysis Profile {analysis_profile_uuid} failed while processing, creating a new one"
+            )
+            self.registry.remove(key)
+            return None
+        return analysis_profile
+
+    def create_analysis_profile(self):
+        # Create a new specialized Analysis Profile for event response,
+        # unless an identical one has been created before.
+        fx_profile = self.retrieve_fx_profile()
+        key = self.analysis_profile_key(fx_profile)
+        analysis_profile = self.find_registered_analysis_profile(key)
+        if analysis_profile is not None:
+            alert.info(
+                f"Reusing Analysis Profile {analysis_profile.id} created with the same parameters",
+                success=True,
+            )
+            return analysis_profile.id
 
-            analysis_profile = analyzere.AnalysisProfile()
-            analysis_profile.event_catalogs = [catalog]
-            analysis_profile.simulation = simulation
-            analysis_profile.description = self.analysis_profile_description
-            analysis_profile.loss_filters = self.create_loss_filters()
-            analysis_profile.exchange_rate_profile = (
-                self.retrieve_fx_profile()
+        # Only the simulation depends on the catalog, so the simulation
+        # data and loss filters are prepared while the catalog is being
+        # created and processed.
+        try:
+            results = (
+                TaskGraph()
+                .add("catalog", self.create_catalog)
+                .add("simulation_data", self.build_simulation_data)
+                .add(
+                    "simulation",
+                    self.upload_catalog_simulation,
+                    "catalog",
+                    "simulation_data",
+                )
+                .add("loss_filters", self.create_loss_filters)
+                .add(
+                    "analysis_profile",
+                    partial(
+                        self.save_analysis_profile, fx_profile=fx_profile
+                    ),
+                    "catalog",
+                    "simulation",
+                    "loss_filters",
+                )
+                .run()
             )
-            analysis_profile.save()
-            check_resource_upload_status(analysis_profile)
+            analysis_profile = results["analysis_profile"]
         except Exception as e:
             alert.exception(
                 f"Exception occured while creating Analysis Profile: {e}"
@@ -262,6 +467,7 @@ class AnalysisProfileCreator:
                     f"Successfully created Analysis Profile {analysis_profile.id}",
                     success=True,
                 )
+                self.registry.register(key, analysis_profile.id)
                 return analysis_profile.id
             else:
                 alert.error(
@@ -0,0 +1,86 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+from utils.alert import Alert as alert
+
+
+class AnalysisProfileRegistry:
+    """
+    Local registry of the Analysis Profiles created with the convolution
+    method, keyed by the parameters the profiles were built from, and of
+    the single event Loss Filters they use, per server.
+
+    The registry is stored as a JSON file. An empty path disables the
+    registry, in which case lookups never find a profile or filter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as registry_file:
+                return json.load(registry_file)
+        except (OSError, ValueError) as e:
+            alert.warning(
+                f"Ignoring unreadable Analysis Profile registry {self.path}: {e}"
+            )
+            return {}
+
+    def _store(self, entries):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so that an interrupted run can't
+        # leave a truncated registry behind.
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as registry_file:
+            json.dump(entries, registry_file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self._load().get(key)
+        return entry["analysis_profile_uuid"] if entry else None
+
+    def register(self, key, analysis_profile_uuid):
+        if not self.path:
+            return
+        with self._lock:
+            entries = self._load()
+            entries[key] = {
+                "analysis_profile_uuid": analysis_profile_uuid,
+                "created": datetime.now().isoformat(),
+            }
+            self._store(entries)
+
+    def lookup_loss_filters(self, server):
+        # Returns the UUIDs of the event filters created on the server,
+        # keyed by event ID
+        with self._lock:
+            entry = self._load().get(f"loss_filters {server}", {})
+        return {int(event_id): uuid for event_id, uuid in entry.items()}
+
+    def register_loss_filters(self, server, loss_filter_uuids):
+        if not self.path:
+            return
+        with self._lock:
+            entries = self._load()
+            entries.setdefault(f"loss_filters {server}", {}).update(
+                (str(event_id), uuid)
+                for event_id, uuid in loss_filter_uuids.items()
+            )
+            self._store(entries)
+
+    def remove(self, key):
+        if not self.path:
+            return
+        with self._lock:
+            entries = self._load()
+            if entries.pop(key, None) is not None:
+                self._store(entries)
@@ -4,24 +4,26 @@ import logging.config
 import shutil
 import configparser
 import argparse
+import multiprocessing
 import pytz
 from datetime import datetime
 from types import SimpleNamespace
 
-import analyzere
-
 from utils.alert import Alert as alert
-from utils.file_handler import read_input_file, file_exists
-from layer_loss_duplicator.duplicate_layer_loss import LayerLossDuplicator
-from ap_creator.create_ap import AnalysisProfileCreator
 
+# NOTE: pandas, analyzere and the modules depending on them are imported
+# where they are first used, so that the command line is parsed without
+# waiting for them to load.
 
-# Load config file
-config_file = os.path.abspath("config/event_response_config.ini")
-if not os.path.exists(config_file):
-    alert.error("Config file not present. Cannot continue.")
 config = configparser.ConfigParser()
-config.read(config_file)
+
+
+def load_config():
+    # Load config file
+    config_file = os.path.abspath("config/event_response_config.ini")
+    if not os.path.exists(config_file):
+        alert.error("Config file not present. Cannot continue.")
+    config.read(config_file)
 
 
 class EventResponseHandler:
@@ -29,11 +31,64 @@ class EventResponseHandler:
         self.output_dir = output_dir
         self.event_response_inputs = event_response_inputs
 
+    def read_event_weights(self):
+        from utils.file_handler import read_input_file
+
+        # A single CSV holds the event weights of a single scenario. Given
+        # several CSVs, every one is a scenario named after its file.
+        event_weights_csv = self.event_response_inputs.event_weights_csv
+        if isinstance(event_weights_csv, str):
+            return read_input_file(event_weights_csv)
+        if len(event_weights_csv) == 1:
+            return read_input_file(event_weights_csv[0])
+
+        scenarios = {}
+        for path in event_weights_csv:
+            name = os.path.splitext(os.path.basename(path))[0]
+            unique_name, suffix = name, 1
+            while unique_name in scenarios:
+                suffix += 1
+                unique_name = f"{name}_{suffix}"
+            scenarios[unique_name] = read_input_file(path)
+        alert.info(
+            f"Processing {len(scenarios)} scenarios: {', '.join(scenarios)}"
+        )
+        return scenarios
+
+    def find_previous_runs(self, scenario_names, resume_from):
+        from layer_loss_duplicator.run_manifest import PreviousRun
+
+        # Previous run of every scenario, whose scaled loss sets are reused
+        previous_runs = {}
+        for name in scenario_names:
+            if resume_from:
+                # Reuse what the resumed run already scaled
+                previous_run = PreviousRun.load(
+                    resume_from
+                    if name is None
+                    else os.path.join(resume_from, name)
+                )
+            else:
+                previous_run = PreviousRun.find_latest(
+                    config.get("defaults", "output_directory"),
+                    exclude=self.output_dir,
+                    scenario=name,
+                )
+                if previous_run is None:
+                    alert.warning(
+                        "No previous run manifest found, processing all loss sets"
+                    )
+            previous_runs[name] = previous_run
+        return previous_runs
+
     def execute(self):
+        from ap_creator.create_ap import AnalysisProfileCreator
+        from layer_loss_duplicator.duplicate_layer_loss import (
+            LayerLossDuplicator,
+        )
+
         if self.event_response_inputs.event_weights_csv:
-            self.event_weights_df = read_input_file(
-                self.event_response_inputs.event_weights_csv
-            )
+            self.event_weights_df = self.read_event_weights()
         # METHOD 1 - MIXTURE DISTRIBUTION METHOD
         if self.event_response_inputs.mixture_distribution_method:
             alert.info("Using Mixture Distribution method")
@@ -69,12 +124,28 @@ class EventResponseHandler:
             if (
                 self.event_response_inputs.layer_views_csv
                 or self.event_response_inputs.portfolio_view_uuid
+                or getattr(self.event_response_inputs, "resume_from", None)
             ):
                 if not analysis_profile_uuid:
                     analysis_profile_uuid = (
                         self.event_response_inputs.analysis_profile_uuid_for_loss_update
                     )
 
+                # Reuse the scaled loss sets of the last run where possible
+                previous_runs = None
+                resume_from = getattr(
+                    self.event_response_inputs, "resume_from", None
+                )
+                if resume_from or getattr(
+                    self.event_response_inputs, "incremental", False
+                ):
+                    previous_runs = self.find_previous_runs(
+                        self.event_weights_df.keys()
+                        if isinstance(self.event_weights_df, dict)
+                        else [None],
+                        resume_from,
+                    )
+
                 modify_layer_loss = LayerLossDuplicator(
                     config=config,
                     output_dir=self.output_dir,
@@ -82,6 +153,8 @@ class EventResponseHandler:
                     analysis_profile_uuid=analysis_profile_uuid,
                     layer_ids_csv=self.event_response_inputs.layer_views_csv,
                     portfolio_uuid=self.event_response_inputs.portfolio_view_uuid,
+                    previous_runs=previous_runs,
+                    resume_from=resume_from,
                 )
                 modify_layer_loss.modify_layer_loss_data()
 
@@ -114,6 +187,20 @@ def init_directories():
 
 
 def login(url, username, password):
+    import analyzere
+    from utils.http_session import configure_session
+    from layer_loss_duplicator.duplicate_layer_loss import METRICS_THREADS
+    from ap_creator.create_ap import LOSS_FILTER_THREADS
+
+    # Size the connection pool for the busiest phase: the layer workers and
+    # the layer structure workers, or the metrics and loss filter workers
+    configure_session(
+        max(
+            2 * multiprocessing.cpu_count() + 1,
+            METRICS_THREADS,
+            LOSS_FILTER_THREADS,
+        )
+    )
     try:
         analyzere.base_url = url
         analyzere.username = username
@@ -142,6 +229,13 @@ def validate_inputs(event_response_inputs):
             alert.error(
                 "Please input the path of the CSV containing event weights"
             )
+        elif (
+            not isinstance(event_response_inputs.event_weights_csv, str)
+            and len(event_response_inputs.event_weights_csv) > 1
+        ):
+            alert.error(
+                "The Mixture Distribution method accepts a single event weights CSV"
+            )
         if not event_response_inputs.old_analysis_profile_uuid:
             alert.error(
                 "Please provide the existing Analysis Profile UUID in 'old_analysis_profile_uuid' field for Mixture Distribution method"
@@ -174,8 +268,11 @@ def validate_inputs(event_response_inputs):
 
             # If an existing Analysis Profile UUID is provided, check if layer_views_csv or portfolio_view_uuid is provided
             if event_response_inputs.analysis_profile_uuid_for_loss_update:
-                if not (event_response_inputs.layer_views_csv or 
-                        event_response_inputs.portfolio_view_uuid):
+                if not (
+                    event_response_inputs.layer_views_csv
+                    or event_response_inputs.portfolio_view_uuid
+                    or getattr(event_response_inputs, "resume_from", None)
+                ):
                     alert.error(
                         "Please input either layer_views_csv or portfolio_view_uuid for processing the LayerViews and LossSets"
                     )
@@ -280,6 +377,13 @@ def process(event_response_inputs):
     #     portfolio_view_uuid - The UUID of the portfolio_view (from where layer_views can be retrieved)
     #     analysis_profile_uuid_for_loss_update - The UUID of the existing Analysis Profile to be used for updating LayerViews and LossSets
 
+    from utils.file_handler import file_exists
+    from utils.resource_cache import resource_cache
+    from utils.loss_data_cache import loss_data_cache
+    from utils.http_session import log_pool_statistics
+    from layer_loss_duplicator.duplicate_layer_loss import FAILED_LAYERS_FILE
+
+    load_config()
     init_logging()
     output_dir = init_directories()
 
@@ -290,22 +394,40 @@ def process(event_response_inputs):
     validate_inputs(event_response_inputs)
 
     # Check if the input files exist
+    event_weights_csv = event_response_inputs.event_weights_csv
+    if event_weights_csv is None or isinstance(event_weights_csv, str):
+        event_weights_csv = [event_weights_csv]
     for input_file in [
-        event_response_inputs.event_weights_csv,
+        *event_weights_csv,
         event_response_inputs.layer_views_csv,
     ]:
         file_exists(input_file)
+    if getattr(event_response_inputs, "resume_from", None):
+        file_exists(
+            os.path.join(
+                event_response_inputs.resume_from, FAILED_LAYERS_FILE
+            )
+        )
 
     login(
         event_response_inputs.analyzere_url,
         event_response_inputs.analyzere_username,
         event_response_inputs.analyzere_password,
     )
+    resource_cache.configure(
+        config.get("cache", "directory", fallback=None),
+        config.get("cache", "ttl", fallback=None),
+    )
+    loss_data_cache.configure(
+        config.get("cache", "loss_data_directory", fallback=None),
+        config.get("cache", "loss_data_max_size_mb", fallback=None),
+    )
 
     event_response_handler = EventResponseHandler(
         output_dir=output_dir, event_response_inputs=event_response_inputs
     )
     event_response_handler.execute()
+    log_pool_statistics()
 
 
 def construct_argument_parser():
@@ -319,8 +441,11 @@ def construct_argument_parser():
     # Event weight CSV
     parser.add_argument(
         "--event_weights_csv",
+        nargs="+",
         help="The path of the CSV file containing events and their "
-        "corresponding weights",
+        "corresponding weights. Several CSV files process one scenario "
+        "each in a single run, with the results of every scenario written "
+        "to a subdirectory named after its file",
     )
 
     # Choices for deciding between Mixture distribution and convolution method
@@ -408,6 +533,20 @@ def construct_argument_parser():
         help="UUID of the existing AnalysisProfile to which the LayerViews and LossSets are to be duplicated",
     )
 
+    # Incremental rerun based on the manifest of the previous run
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only scale again the loss sets containing events whose weight changed since the previous run",
+    )
+
+    # Rerun of the layers that failed in a previous run
+    parser.add_argument(
+        "--resume_from",
+        "--resume-from",
+        help="Archive directory of a previous run whose failed Layers are to be processed again",
+    )
+
     return parser
 
 
@@ -449,6 +588,8 @@ if __name__ == "__main__":
     layer_views_csv = args.layer_views_csv
     portfolio_view_uuid = args.portfolio_view_uuid
     analysis_profile_uuid_for_loss_update = args.analysis_profile_uuid_for_loss_update
+    incremental = args.incremental
+    resume_from = args.resume_from
 
 
     event_response_inputs = SimpleNamespace(
@@ -472,6 +613,8 @@ if __name__ == "__main__":
         layer_views_csv=layer_views_csv,
         portfolio_view_uuid=portfolio_view_uuid,
         analysis_profile_uuid_for_loss_update=analysis_profile_uuid_for_loss_update,
+        incremental=incremental,
+        resume_from=resume_from,
     )
 
     process(event_response_inputs)
@@ -1,27 +1,86 @@
+import os
 import sys
+import copy
+import time
 import multiprocessing
 import logging
-from concurrent.futures import ThreadPoolExecutor
-
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import ExitStack
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import requests
 import analyzere
+from analyzere import errors as are_errors
+from analyzere import utils as are_utils
 from analyzere.base_resources import Reference
 from analyzere import MonetaryUnit
-import ipywidgets as widgets
-from IPython.display import display, FileLink
 
 from utils.alert import Alert as alert
-from utils.are_resources import check_resource_upload_status
+from utils.are_resources import (
+    check_resource_upload_status,
+    list_resources,
+    then,
+)
+from utils.resource_cache import resource_cache
+from utils.loss_data_cache import loss_data_cache
 from utils.file_handler import (
     read_input_file,
     write_output_file,
     find_column,
-    join,
-    read_byte_stream_into_csv,
+)
+from layer_loss_duplicator.event_weights import EventWeights, ScenarioWeights
+from layer_loss_duplicator.scenario import Scenario
+from layer_loss_duplicator.loss_scaling import (
+    ScalingPool,
+    filter_elt_chunk,
+    scale_elt,
+    scale_yelt_chunk,
 )
 
 
 logger = logging.getLogger()
 
+# Resources referenced from layer structures that are prefetched in bulk
+PREFETCHED_RESOURCES = [
+    analyzere.LayerView,
+    analyzere.Layer,
+    analyzere.LossSet,
+]
+# Attributes of LayerViews and Layers holding a single sub-layer and a list
+# of sub-layers or loss sets
+LAYER_ATTRIBUTES = ["layer", "sink"]
+LAYER_LIST_ATTRIBUTES = ["sources", "loss_sets"]
+
+# Number of metrics requests sent concurrently once all LayerViews exist
+METRICS_THREADS = 16
+
+# Layers failing with a transient error, like a lost connection or a server
+# error, are attempted up to MAX_ATTEMPTS times, waiting RETRY_DELAY seconds
+# before the first retry and twice as long before every following one
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 5
+TRANSIENT_ERRORS = (
+    are_errors.ServerError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+FAILED_LAYERS_FILE = "failed_layers.csv"
+
+
+def in_notebook():
+    # IPython is always loaded in a notebook, it isn't imported otherwise
+    ipython = sys.modules.get("IPython")
+    if ipython is None:
+        return False
+    shell = ipython.get_ipython()
+    return type(shell).__name__ == "ZMQInteractiveShell"
+
 
 class LayerLossDuplicator:
     def __init__(
@@ -32,23 +91,69 @@ class LayerLossDuplicator:
         analysis_profile_uuid,
         layer_ids_csv=None,
         portfolio_uuid=None,
+        previous_runs=None,
+        resume_from=None,
     ):
+        # event_weights_df is either the weights of a single scenario, or a
+        # dictionary of scenario name : weights to process several scenarios
+        # in a single pass. Every scenario records its run in its own
+        # directory, and reuses the loss sets of its previous run if given.
+        if not isinstance(event_weights_df, dict):
+            event_weights_df = {None: event_weights_df}
+        previous_runs = previous_runs or {}
         self.output_dir = output_dir
-        self.event_weights_df = event_weights_df
+        self.aggregate_secondary_uncertainty = config.getboolean(
+            "defaults", "aggregate_secondary_uncertainty", fallback=False
+        )
+        self.scenarios = [
+            Scenario(
+                name,
+                EventWeights(weights_df),
+                analysis_profile_uuid,
+                output_dir
+                if name is None
+                else os.path.join(output_dir, name),
+                previous_runs.get(name),
+                self.aggregate_secondary_uncertainty,
+                resumed=bool(resume_from),
+            )
+            for name, weights_df in event_weights_df.items()
+        ]
+        self.scenario_weights = ScenarioWeights(
+            [scenario.event_weights for scenario in self.scenarios]
+        )
         self.analysis_profile = self.retrieve_analysis_profile(
             analysis_profile_uuid
         )
         self.event_catalogs = self.analysis_profile.event_catalogs
         self.layer_ids_csv = layer_ids_csv
         self.portfolio_uuid = portfolio_uuid
+        self.resume_from = resume_from
         self.config = config
 
         self.layer_list = []  # List of LayerViews
-        self.loss_set_mapping = {}  # Old LossSet UUID : New LossSet UUID
+        # (LayerView UUID, scenario index) of the layers to process
+        self.layer_tasks = []
+        self.layer_views = {}  # Prefetched LayerView UUID : LayerView
+        # (LayerView UUID, scenario, error) of failed layers
+        self.failed_layers = []
+        # Old LossSet UUID : Future of the transformed LossSets per scenario
+        self.loss_set_futures = {}
+        # (Scenario index, layer key) : Future of the transformed Layer
+        self.layer_futures = {}
+        # (Metric, LayerView UUID) : Future of the metric
+        self.metrics_futures = {}
+        self.once_lock = threading.Lock()
+        # Worker pool for the sub-trees of layer structures
+        self.layer_executor = None
+        # Process pool for parsing and scaling loss data
+        self.scaling_pool = None
 
     def retrieve_analysis_profile(self, ap_uuid):
         try:
-            analysis_profile = analyzere.AnalysisProfile.retrieve(ap_uuid)
+            analysis_profile = resource_cache.retrieve(
+                analyzere.AnalysisProfile, ap_uuid
+            )
         except Exception as e:
             alert.exception(
                 f"Exception occured while retrieving Analysis Profile {ap_uuid}: {e}"
@@ -59,8 +164,40 @@ class LayerLossDuplicator:
             )
             return analysis_profile
 
+    @property
+    def multiple_scenarios(self):
+        return len(self.scenarios) > 1
+
     def extract_layers(self):
-        if (
+        # Every layer is processed for every scenario
+        self.layer_tasks = []
+        if self.resume_from:
+            # Only process the layers that failed in the given run, and only
+            # for the scenarios they failed in
+            failed_layers_df = read_input_file(
+                os.path.join(self.resume_from, FAILED_LAYERS_FILE)
+            )
+            columns = failed_layers_df.columns.tolist()
+            layer_column = find_column("layer", columns)
+            scenario_column = find_column("scenario", columns)
+            self.layer_list = failed_layers_df[layer_column].unique().tolist()
+            if scenario_column is not None:
+                indexes = {
+                    scenario.name: index
+                    for index, scenario in enumerate(self.scenarios)
+                }
+                self.layer_tasks = [
+                    (layer_uuid, indexes[name])
+                    for layer_uuid, name in zip(
+                        failed_layers_df[layer_column],
+                        failed_layers_df[scenario_column],
+                    )
+                    if name in indexes
+                ]
+            alert.info(
+                f"Resuming {len(self.layer_list)} failed Layers from {self.resume_from}"
+            )
+        elif (
             not self.layer_ids_csv is None
             and len(str(self.layer_ids_csv)) > 0
         ):
@@ -90,6 +227,106 @@ class LayerLossDuplicator:
                         f"Fetched {len(self.layer_list)} LayerView from PortfolioView {self.portfolio_uuid}"
                     )
 
+        if not self.layer_tasks:
+            self.layer_tasks = [
+                (layer_uuid, index)
+                for layer_uuid in self.layer_list
+                for index in range(len(self.scenarios))
+            ]
+
+    def find_references(self, nodes):
+        # Yields (holder, attribute, index, reference) for every unresolved
+        # reference in the layer structures below the given nodes. Index is
+        # None for attributes holding a single sub-layer.
+        stack = list(nodes)
+        visited = set()
+        while stack:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+
+            children = [
+                (attribute, None, getattr(node, attribute, None))
+                for attribute in LAYER_ATTRIBUTES
+            ]
+            for attribute in LAYER_LIST_ATTRIBUTES:
+                children.extend(
+                    (attribute, index, child)
+                    for index, child in enumerate(
+                        getattr(node, attribute, None) or []
+                    )
+                )
+
+            for attribute, index, child in children:
+                if isinstance(child, Reference):
+                    collection, _ = are_utils.parse_href(child._href)
+                    yield node, attribute, index, (collection, child._id)
+                elif getattr(child, "ref_id", None):
+                    # See transform_layer, ref_id refers to a LayerView
+                    collection = analyzere.LayerView._get_collection_name()
+                    yield node, attribute, index, (collection, child.ref_id)
+                elif attribute in LAYER_ATTRIBUTES + ["sources"] and child:
+                    stack.append(child)
+
+    def prefetch_layers(self):
+        # Fetch the LayerViews and everything their layer structures refer
+        # to with paged list requests, so that the workers process a local
+        # object graph instead of resolving references one by one.
+        resource_classes = {
+            resource_class._get_collection_name(): resource_class
+            for resource_class in PREFETCHED_RESOURCES
+        }
+        try:
+            self.layer_views = list_resources(
+                analyzere.LayerView, self.layer_list
+            )
+            prefetched = {
+                (analyzere.LayerView._get_collection_name(), id_): layer_view
+                for id_, layer_view in self.layer_views.items()
+            }
+            nodes = list(self.layer_views.values())
+            while nodes:
+                references = [
+                    reference
+                    for reference in self.find_references(nodes)
+                    if reference[3][0] in resource_classes
+                ]
+                missing = {}
+                for *_, (collection, id_) in references:
+                    if (collection, id_) not in prefetched:
+                        missing.setdefault(collection, []).append(id_)
+                for collection, ids in missing.items():
+                    alert.debug(f"Prefetching {len(ids)} {collection}")
+                    listed = list_resources(resource_classes[collection], ids)
+                    prefetched.update(
+                        ((collection, id_), resource)
+                        for id_, resource in listed.items()
+                    )
+
+                # Replace the references with the prefetched resources and
+                # continue with the structures of the resolved layers
+                nodes = []
+                for node, attribute, index, key in references:
+                    resource = prefetched.get(key)
+                    if resource is None:
+                        continue
+                    if index is None:
+                        setattr(node, attribute, resource)
+                    else:
+                        getattr(node, attribute)[index] = resource
+                    if not isinstance(resource, analyzere.LossSet):
+                        nodes.append(resource)
+        except Exception as e:
+            # The layers are still resolved one by one while processing them
+            alert.warning(f"Unable to prefetch layer structures: {e}")
+        else:
+            referenced = len(prefetched) - len(self.layer_views)
+            alert.info(
+                f"Prefetched {len(self.layer_views)} LayerViews and "
+                f"{referenced} referenced resources"
+            )
+
     # Generic Layer to replace filter layer in structure
     def replace_filter_layer(self, loss_sets):
         unlimited = sys.float_info.max
@@ -107,126 +344,211 @@ class LayerLossDuplicator:
         ).save()
         return generic_layer
 
-    def scale_elt(self, elt_df, loss_set):
+    def scale_yelt(self, loss_set, scenario_indexes, scaled_files):
+        # Streams the YELT chunk by chunk through the scaling pool, writing
+        # the scaled rows of every scenario to its CSV file, so that memory
+        # stays bounded by the chunk size. Returns the distinct event IDs
+        # of the YELT.
         alert.debug(f"Scaling loss_set {loss_set.id}")
-        # Normalize the EventId column
-        event_id_column_in_elt = find_column("event", elt_df.columns.tolist())
-        event_id_column_in_weights = find_column(
-            "event", self.event_weights_df.columns.tolist()
-        )
-        weight_column = find_column("weight", self.event_weights_df.columns.tolist())
-        self.event_weights_df = self.event_weights_df.rename(
-            columns={event_id_column_in_weights: event_id_column_in_elt,
-                     weight_column: "weight"}
-        )
+        event_ids = np.array([], dtype=np.int64)
+        with loss_data_cache.chunk_sources(loss_set) as sources:
+            for index, (chunk_event_ids, columns, scaled_yelts) in enumerate(
+                self.scaling_pool.map(
+                    scale_yelt_chunk, sources, scenario_indexes
+                )
+            ):
+                event_ids = np.union1d(event_ids, chunk_event_ids)
+                for scaled_file, scaled_yelt in zip(
+                    scaled_files, scaled_yelts
+                ):
+                    if index == 0:
+                        scaled_file.write(",".join(columns) + "\n")
+                    scaled_file.write(scaled_yelt)
+        return event_ids
 
-        # Perform left-join of weights table and loss set table.
-        # Only events that occur in the weights table will remain.
-        weighted_elt_df = join(
-            self.event_weights_df,
-            elt_df,
-            how="left",
-            on=event_id_column_in_elt,
-        )
-        weighted_elt_df = weighted_elt_df.rename(
-            mapper=lambda name: name.upper(), axis=1
-        )
-        weighted_elt_df.dropna(inplace=True)
+    def transform_loss_set(self, loss_set):
+        # Returns the transformed loss set of every scenario
+        transformed = [
+            scenario.reuse_loss_set(loss_set) for scenario in self.scenarios
+        ]
+        pending = [
+            index
+            for index, scaled_loss_set in enumerate(transformed)
+            if scaled_loss_set is None
+        ]
+        if not pending:
+            return transformed
 
-        try:
-            if len(weighted_elt_df.columns) < 6:
-                # ELT without secondary uncertainty (maybe AIR)
-                alert.debug(
-                    f"ELT {loss_set.id} without secondary uncertainty"
-                )
-                # Scale mean loss value
-                scaled_loss = weighted_elt_df.LOSS * weighted_elt_df.WEIGHT
-                weighted_elt_df["LOSS"] = scaled_loss
-                weighted_elt_df["STDDEVC"] = 0
-                weighted_elt_df["STDDEVI"] = 0
-                # Set exposure value equal to the scaled loss
-                weighted_elt_df["EXPVALUE"] = scaled_loss
-                # Remove EventID and Weight columns
-                weighted_elt_df = weighted_elt_df.drop(
-                    ["EVENTID", "WEIGHT"], axis=1
-                )
-                # Set EventId for all entries to 1
-                # NOTE: The platform will automatically combine multiple entries with the same event ID into a single occurrence.
-                weighted_elt_df["EVENTID"] = 1
+        alert.debug(f"Transforming loss_set {loss_set.id}")
+        # Loss data is downloaded on this thread and parsed, filtered,
+        # scaled and encoded in the scaling pool, once for all scenarios
+        with ExitStack() as stack:
+            if loss_set.type == "YELTLossSet":
+                # YELTs keep their trials, their weighted events are mapped
+                # onto event 1 of the catalog like those of ELTs. They are
+                # written to temporary files as they can be much larger than
+                # ELTs.
+                scaled_data = [
+                    stack.enter_context(tempfile.TemporaryFile("w+"))
+                    for _ in pending
+                ]
+                event_ids = self.scale_yelt(loss_set, pending, scaled_data)
+                for scaled_file in scaled_data:
+                    scaled_file.seek(0)
+                attributes = {
+                    "event_catalogs": self.event_catalogs,
+                    "start_date": loss_set.start_date,
+                    "trial_count": loss_set.trial_count,
+                }
             else:
-                # ELT with secondary uncertainty (likely RMS)
-                alert.debug(f"ELT {loss_set.id} with secondary uncertainty")
-                # Scale mean loss value
-                weighted_elt_df["PERSPVALUE"] = (
-                    weighted_elt_df.PERSPVALUE * weighted_elt_df.WEIGHT
-                )
-                # Scale independent standard deviation
-                weighted_elt_df["STDDEVI"] = (
-                    weighted_elt_df.STDDEVI * weighted_elt_df.WEIGHT
-                )
-                # Scale correlated standard deviation
-                weighted_elt_df["STDDEVC"] = (
-                    weighted_elt_df.STDDEVC * weighted_elt_df.WEIGHT
-                )
-                # Scale exposure value
-                weighted_elt_df["EXPVALUE"] = (
-                    weighted_elt_df.EXPVALUE * weighted_elt_df.WEIGHT
-                )
-                # Remove EventID and Weight columns
-                weighted_elt_df = weighted_elt_df.drop(
-                    ["EVENTID", "WEIGHT"], axis=1
+                # Only the rows of weighted events are sent back from the
+                # pool, and the ELT is streamed from the local cache if
+                # possible
+                rows = []
+                event_ids = np.array([], dtype=np.int64)
+                with loss_data_cache.chunk_sources(loss_set) as sources:
+                    for chunk_rows, chunk_event_ids in self.scaling_pool.map(
+                        filter_elt_chunk, sources
+                    ):
+                        rows.append(chunk_rows)
+                        event_ids = np.union1d(event_ids, chunk_event_ids)
+                elt_df = pd.concat(rows, ignore_index=True)
+                # Scale and transform loss set data
+                alert.debug(f"Scaling loss_set {loss_set.id}")
+                scaled_data = self.scaling_pool.submit(
+                    scale_elt,
+                    elt_df,
+                    pending,
+                    self.aggregate_secondary_uncertainty,
+                ).result()
+                attributes = {"event_catalogs": self.event_catalogs}
+
+            def upload(index, data):
+                scenario = self.scenarios[index]
+                new_description = f"ER_{loss_set.description}"
+                if scenario.name is not None:
+                    new_description = (
+                        f"ER_{scenario.name}_{loss_set.description}"
+                    )
+                return self.upload_loss_set(
+                    loss_set.type,
+                    new_description,
+                    data,
+                    loss_set.currency,
+                    **attributes,
                 )
-                # Set EventId for all entries to 1
-                # NOTE: The platform will automatically combine multiple entries with the same event ID into a single occurrence.
-                weighted_elt_df["EVENTID"] = 1
-        except Exception as e:
-            alert.exception(
-                f"Exception occured while scaling Loss Set {loss_set.id}: {e}"
-            )
-        else:
-            return weighted_elt_df
 
-    def transform_loss_set(self, loss_set):
-        alert.debug(f"Transforming loss_set {loss_set.id}")
-        old_elt_data = loss_set.download_data()
-        elt_df = read_byte_stream_into_csv(old_elt_data)
-        # Scale and transform loss set data and save into string buffer
-        scaled_df = self.scale_elt(elt_df, loss_set)
-        if scaled_df is not None:
-            new_description = f"ER_{loss_set.description}"
-            new_loss_set = self.upload_elt(
-                new_description,
-                scaled_df.to_csv(index=False),
-                loss_set.currency,
-                self.event_catalogs,
+            # Upload the loss sets of the scenarios concurrently
+            processed = self.map_concurrently(
+                lambda args: upload(*args), list(zip(pending, scaled_data))
             )
-            return new_loss_set
 
-    def upload_elt(self, description, elt, currency, catalogs):
-        try:
-            loss_set = analyzere.LossSet(
-                type="ELTLossSet",
-                description=description,
-                event_catalogs=catalogs,
-                currency=currency,
-                loss_type=self.config.get("defaults", "loss_perspective"),
-            ).save()
-            loss_set.upload_data(elt)
-            check_resource_upload_status(loss_set)
-        except Exception as e:
-            alert.exception(
-                f"Exception occured while uploading ELT {loss_set.id}: {e}"
-            )
-        if loss_set.status == "processing_succeeded":
-            alert.debug(f"Uploaded loss_set {loss_set.id}")
-        else:
-            alert.error(
-                f"LossSet {loss_set.id} was uploaded, but failed while processing. {loss_set.status_message}"
+        # All uploaded loss sets are processed at the same time, the scaled
+        # data is released before waiting for them
+        for index, future in zip(pending, processed):
+            new_loss_set = future.result()
+            self.scenarios[index].record_loss_set(
+                loss_set, event_ids, new_loss_set
             )
+            transformed[index] = new_loss_set
+        return transformed
+
+    def run_once(self, futures, key, func, *args):
+        # The first thread to encounter a key runs func, all others wait for
+        # and share its result. Failures are not kept, so that a retry runs
+        # func again.
+        with self.once_lock:
+            future = futures.get(key)
+            owner = future is None
+            if owner:
+                future = futures[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                with self.once_lock:
+                    del futures[key]
+                future.set_exception(e)
+                raise
+
+        return future.result()
+
+    def transform_loss_set_once(self, loss_set):
+        # Loss sets shared by several layers are transformed only once
+        return self.run_once(
+            self.loss_set_futures,
+            loss_set.id,
+            self.transform_loss_set,
+            loss_set,
+        )
 
-        return loss_set
+    def map_concurrently(self, func, items):
+        # Runs func on the layer worker pool for every item. Items that no
+        # worker has picked up yet when their result is needed are run by
+        # the calling thread instead, so that waiting for nested sub-trees
+        # can never exhaust the pool.
+        if self.layer_executor is None or len(items) < 2:
+            return [func(item) for item in items]
+
+        futures = [self.layer_executor.submit(func, item) for item in items]
+        return [
+            func(item) if future.cancel() else future.result()
+            for item, future in zip(items, futures)
+        ]
+
+    def upload_loss_set(
+        self, loss_set_type, description, data, currency, **attributes
+    ):
+        loss_set = analyzere.LossSet(
+            type=loss_set_type,
+            description=description,
+            currency=currency,
+            loss_type=self.config.get("defaults", "loss_perspective"),
+            **attributes,
+        ).save()
+        loss_set.upload_data(data)
+
+        def validate(loss_set):
+            if loss_set.status == "processing_succeeded":
+                alert.debug(f"Uploaded loss_set {loss_set.id}")
+            else:
+                raise ValueError(
+                    f"LossSet {loss_set.id} was uploaded, but failed while processing. {loss_set.status_message}"
+                )
+            return loss_set
+
+        # Returns a future of the loss set instead of waiting for it to be
+        # processed
+        return then(check_resource_upload_status(loss_set), validate)
+
+    def layer_key(self, layer, scenario_index):
+        # Identifies the nodes of layer structures that may be shared, nodes
+        # without an ID are inlined and can't be shared.
+        if isinstance(layer, Reference):
+            return (scenario_index, "Reference", layer._id)
+        if getattr(layer, "ref_id", None):
+            return (scenario_index, "LayerView", layer.ref_id)
+        if getattr(layer, "id", None):
+            return (scenario_index, type(layer).__name__, layer.id)
+        return None
+
+    def modify_layer(self, layer, scenario_index):
+        # Each distinct node of the layer structures is fetched and
+        # transformed once per run and scenario, however often it is
+        # referenced.
+        key = self.layer_key(layer, scenario_index)
+        if key is None:
+            return self.transform_layer(layer, scenario_index)
+        return self.run_once(
+            self.layer_futures,
+            key,
+            self.transform_layer,
+            layer,
+            scenario_index,
+        )
 
-    def modify_layer(self, layer):
+    def transform_layer(self, layer, scenario_index):
         # Recursively process the layer structure and transform loss sets
         if hasattr(layer, "ref_id"):
             layer = analyzere.LayerView.retrieve(layer.ref_id).layer
@@ -235,93 +557,227 @@ class LayerLossDuplicator:
         if type(layer) in [analyzere.LayerView, Reference]:
             layer = layer.layer
         if layer.type == "BackAllocatedLayer":
-            logger.exception("Back Allocated layers are not supported")
-            raise
+            raise ValueError("Back Allocated layers are not supported")
 
         if layer.type == "NestedLayer":
-            layer.sink = self.modify_layer(layer.sink)
-            layer.sources = [self.modify_layer(s) for s in layer.sources]
+            # The sink and the sources are independent sub-trees
+            transformed = self.map_concurrently(
+                partial(self.modify_layer, scenario_index=scenario_index),
+                [layer.sink] + list(layer.sources),
+            )
+            layer.sink = transformed[0]
+            layer.sources = transformed[1:]
 
         if hasattr(layer, "loss_sets"):
-            try:
-                # no losses to process
-                if len(layer.loss_sets) == 0 and layer.type != "FilterLayer":
-                    pass
-
-                # Transform the loss sets in the loss set list in-place
-                loss_sets = []
-
-                for _, loss_set in enumerate(layer.loss_sets):
-                    # Check if loss set is already processed
-                    if loss_set.id in self.loss_set_mapping:
-                        loss_sets.append(
-                            analyzere.LossSet.retrieve(
-                                self.loss_set_mapping[loss_set.id]
-                            )
-                        )
-                    # Transform only ELTs
-                    elif loss_set.type == "ELTLossSet":
-                        transformed = self.transform_loss_set(loss_set)
-                        if transformed:
-                            self.loss_set_mapping[
-                                loss_set.id
-                            ] = transformed.id
-                            loss_sets.append(transformed)
-
-                    # If unknown loss set, skip it.
-                    else:
-                        alert.warning(
-                            f"Encountered {loss_set.type} {loss_set.id}, skipping transformation"
-                        )
-                        loss_sets.append(loss_set)
-
-                # Need to replace Filter Layers with unlimited Generic layer
-                if layer.type == "FilterLayer":
-                    layer = self.replace_filter_layer(loss_sets)
-                else:
-                    layer.loss_sets = loss_sets
-            except Exception as e:
-                alert.exception(f"Unable to process layer: {e}")
+            # Transform the loss sets in the loss set list in-place
+            loss_sets = [
+                loss_set
+                for loss_set in self.map_concurrently(
+                    partial(
+                        self.modify_loss_set, scenario_index=scenario_index
+                    ),
+                    layer.loss_sets,
+                )
+                if loss_set is not None
+            ]
+
+            # Need to replace Filter Layers with unlimited Generic layer
+            if layer.type == "FilterLayer":
+                layer = self.replace_filter_layer(loss_sets)
+            else:
+                layer.loss_sets = loss_sets
         return layer
 
-    def process_layer(self, layer_uuid):
-        try:
-            old_layer_view = analyzere.LayerView.retrieve(layer_uuid)
-            # Update LayerView
-            new_layer_view = analyzere.LayerView(
-                analysis_profile=self.analysis_profile,
-                layer=self.modify_layer(old_layer_view),
-            ).save()
-
-            # Create PortfolioViews for aiding the computation of
-            # share applied output metrics
-            new_portfolio_view = analyzere.PortfolioView(
-                analysis_profile=self.analysis_profile,
-                layer_views=[new_layer_view],
-            ).save()
-
-            old_portfolio_view = analyzere.PortfolioView(
-                analysis_profile=old_layer_view.analysis_profile,
-                layer_views=[old_layer_view],
-            ).save()
+    def modify_loss_set(self, loss_set, scenario_index):
+        # Transform only ELTs and YELTs
+        if loss_set.type in ("ELTLossSet", "YELTLossSet"):
+            return self.transform_loss_set_once(loss_set)[scenario_index]
 
-        except Exception as e:
-            alert.exception(
-                f"Exception occurred while modifying Layer {layer_uuid}: {e}"
+        # YLTs only hold the total loss of every trial, without the events
+        # the weights could be applied to
+        if loss_set.type == "YLTLossSet":
+            alert.warning(
+                f"YLTLossSet {loss_set.id} has no event information, keeping it unchanged"
             )
-        else:
-            return (
-                old_layer_view.id,
-                old_layer_view.el(),
-                old_portfolio_view.el(),
-                new_layer_view.id,
-                new_layer_view.el(),
-                new_portfolio_view.el(),
+            return loss_set
+
+        # If unknown loss set, skip it.
+        alert.warning(
+            f"Encountered {loss_set.type} {loss_set.id}, skipping transformation"
+        )
+        return loss_set
+
+    def duplicate_layer(self, layer_uuid, scenario_index, attempt):
+        # The first attempt uses the prefetched LayerView, copied for each
+        # scenario as it is transformed in place. Retries start from a fresh
+        # copy, as a failed attempt may have transformed part of the layer
+        # structure.
+        old_layer_view = self.layer_views.get(layer_uuid)
+        if old_layer_view is None or attempt > 1:
+            old_layer_view = analyzere.LayerView.retrieve(layer_uuid)
+        elif self.multiple_scenarios:
+            old_layer_view = copy.deepcopy(old_layer_view)
+        # Update LayerView
+        new_layer = self.modify_layer(old_layer_view, scenario_index)
+        new_layer_view = analyzere.LayerView(
+            analysis_profile=self.analysis_profile,
+            layer=new_layer,
+        ).save()
+
+        self.scenarios[scenario_index].manifest.record_layer_view(
+            old_layer_view.id, new_layer_view.id
+        )
+        return (
+            scenario_index,
+            old_layer_view,
+            self.layer_share(old_layer_view.layer),
+            new_layer_view,
+            self.layer_share(new_layer),
+        )
+
+    def process_layer(self, layer_uuid, scenario_index):
+        # Errors are recorded per layer instead of ending the run, transient
+        # errors are retried first.
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return self.duplicate_layer(
+                    layer_uuid, scenario_index, attempt
+                )
+            except TRANSIENT_ERRORS as e:
+                if attempt == MAX_ATTEMPTS:
+                    error = e
+                    break
+                delay = RETRY_DELAY * 2 ** (attempt - 1)
+                alert.warning(
+                    f"Attempt {attempt} to modify Layer {layer_uuid} failed, retrying in {delay}s: {e}"
+                )
+                time.sleep(delay)
+            except Exception as e:
+                error = e
+                break
+
+        logger.error(
+            f"Exception occurred while modifying Layer {layer_uuid}: {error}",
+            exc_info=error,
+        )
+        alert.warning(f"Unable to modify Layer {layer_uuid}: {error}")
+        with self.once_lock:
+            self.failed_layers.append(
+                (layer_uuid, self.scenarios[scenario_index].name, str(error))
             )
 
+    def layer_share(self, layer):
+        # The share PortfolioViews apply to a layer is the participation of
+        # its top-level layer. Returns None when it can't be derived here.
+        if getattr(layer, "type", None) == "NestedLayer":
+            return None
+        participation = getattr(layer, "participation", None)
+        if isinstance(participation, (int, float)):
+            return participation
+        return None
+
+    def layer_view_el(self, layer_view):
+        return self.run_once(
+            self.metrics_futures, ("el", layer_view.id), layer_view.el
+        )
+
+    def portfolio_view_el(self, layer_view):
+        # Create a PortfolioView for computing the share applied metrics
+        portfolio_view = analyzere.PortfolioView(
+            analysis_profile=layer_view.analysis_profile,
+            layer_views=[layer_view],
+        ).save()
+        return portfolio_view.el()
+
+    def share_applied_el(self, layer_view, share):
+        if share is not None:
+            return self.layer_view_el(layer_view) * share
+        return self.run_once(
+            self.metrics_futures,
+            ("portfolio_el", layer_view.id),
+            self.portfolio_view_el,
+            layer_view,
+        )
+
+    def retrieve_metrics(self, metric, layer_view, *args):
+        # Missing metrics are reported as empty values
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return metric(layer_view, *args)
+            except TRANSIENT_ERRORS as e:
+                error = e
+                if attempt < MAX_ATTEMPTS:
+                    time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            except Exception as e:
+                error = e
+                break
+        alert.warning(
+            f"Unable to retrieve metrics of LayerView {layer_view.id}: {error}"
+        )
+
+    def compute_metrics(self, processed_layers):
+        # Retrieve the metrics of all old and new LayerViews concurrently
+        with ThreadPoolExecutor(METRICS_THREADS) as executor:
+            metrics = [
+                (
+                    self.scenarios[scenario_index].name,
+                    old_layer_view.id,
+                    executor.submit(
+                        self.retrieve_metrics,
+                        self.layer_view_el,
+                        old_layer_view,
+                    ),
+                    executor.submit(
+                        self.retrieve_metrics,
+                        self.share_applied_el,
+                        old_layer_view,
+                        old_share,
+                    ),
+                    new_layer_view.id,
+                    executor.submit(
+                        self.retrieve_metrics,
+                        self.layer_view_el,
+                        new_layer_view,
+                    ),
+                    executor.submit(
+                        self.retrieve_metrics,
+                        self.share_applied_el,
+                        new_layer_view,
+                        new_share,
+                    ),
+                )
+                for (
+                    scenario_index,
+                    old_layer_view,
+                    old_share,
+                    new_layer_view,
+                    new_share,
+                ) in (
+                    processed_layer
+                    for processed_layer in processed_layers
+                    if processed_layer is not None
+                )
+            ]
+            # Results are only tagged with the scenario if there are several
+            first_column = 0 if self.multiple_scenarios else 1
+            return [
+                tuple(
+                    value.result() if isinstance(value, Future) else value
+                    for value in row[first_column:]
+                )
+                for row in metrics
+            ]
+
     def display_links(self):
         output_file_path = f"{self.output_dir}/results.csv"
         print()
+        if not in_notebook():
+            print(output_file_path)
+            return
+
+        # Notebook only dependencies, loaded when running in a notebook
+        from IPython.display import display, FileLink
+
         display(
             FileLink(
                 output_file_path,
@@ -331,6 +787,7 @@ class LayerLossDuplicator:
 
     def write_results(self, results):
         column_names = [
+            *(["Scenario"] if self.multiple_scenarios else []),
             "Old LayerView UUID",
             "Old LayerView EL (100%)",
             "Old LayerView EL (Share Applied)",
@@ -341,17 +798,63 @@ class LayerLossDuplicator:
         results = write_output_file(
             results, column_names, "results.csv", self.output_dir
         )
-        alert.info(
-            f"Duplication successful!",
-            success=True,
-        )
+        if self.failed_layers:
+            failed_layers = self.failed_layers
+            column_names = ["LayerView UUID", "Scenario", "Error"]
+            if not self.multiple_scenarios:
+                failed_layers = [
+                    (uuid, error) for uuid, _, error in failed_layers
+                ]
+                column_names = ["LayerView UUID", "Error"]
+            write_output_file(
+                failed_layers,
+                column_names,
+                FAILED_LAYERS_FILE,
+                self.output_dir,
+            )
+            alert.warning(
+                f"{len(self.failed_layers)} Layers failed, they are listed in {self.output_dir}/{FAILED_LAYERS_FILE}. "
+                f"Rerun with --resume_from {self.output_dir} to process them again."
+            )
+        else:
+            alert.info(
+                f"Duplication successful!",
+                success=True,
+            )
         self.display_links()
 
     def modify_layer_loss_data(self):
         self.extract_layers()
+        self.prefetch_layers()
+
+        if self.multiple_scenarios:
+            alert.info(
+                f"Processing {len(self.layer_list)} Layers for {len(self.scenarios)} scenarios"
+            )
+        else:
+            alert.info(f"Processing {len(self.layer_list)} Layers")
+        # The scaling pool is started before any thread, and the threads
+        # only wait on network requests and on the scaling pool
+        with ScalingPool(
+            self.scenario_weights
+        ) as self.scaling_pool, ThreadPoolExecutor(
+            multiprocessing.cpu_count()
+        ) as executor, ThreadPoolExecutor(
+            multiprocessing.cpu_count(), thread_name_prefix="layer-tree"
+        ) as self.layer_executor:
+            processed_layers = list(
+                executor.map(
+                    lambda task: self.process_layer(*task), self.layer_tasks
+                )
+            )
+        self.layer_executor = None
+        self.scaling_pool = None
+
+        alert.info(f"Computing metrics of {len(processed_layers)} Layers")
+        results = self.compute_metrics(processed_layers)
 
-        alert.info(f"Processing {len(self.layer_list)} Layers")
-        with ThreadPoolExecutor(multiprocessing.cpu_count()) as executor:
-            results = list(executor.map(self.process_layer, self.layer_list))
+        for scenario in self.scenarios:
+            os.makedirs(scenario.output_dir, exist_ok=True)
+            scenario.manifest.write(scenario.output_dir)
 
         self.write_results(results)
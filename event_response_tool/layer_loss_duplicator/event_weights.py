@@ -0,0 +1,84 @@
+import numpy as np
+
+from utils.file_handler import find_column
+
+
+class EventWeights:
+    """
+    Immutable table of the event weights of one scenario, sorted by event
+    ID. Events listed several times in the weights table have their
+    weights added up. Loss set rows are looked up in ScenarioWeights,
+    which combines the tables of all scenarios.
+    """
+
+    def __init__(self, event_weights_df):
+        columns = event_weights_df.columns.tolist()
+        event_ids = event_weights_df[find_column("event", columns)]
+        weights = event_weights_df[find_column("weight", columns)]
+
+        valid = event_ids.notna() & weights.notna()
+        self.event_ids, inverse = np.unique(
+            event_ids[valid].to_numpy(), return_inverse=True
+        )
+        self.weights = np.bincount(
+            inverse, weights=weights[valid].to_numpy(dtype=np.float64)
+        )
+        self.event_ids.flags.writeable = False
+        self.weights.flags.writeable = False
+
+    def __len__(self):
+        return len(self.event_ids)
+
+
+class ScenarioWeights:
+    """
+    Lookup table from event ID to the event weights of several scenarios.
+
+    The event IDs of all scenarios are sorted together once, so that the
+    weights of any number of loss set rows in every scenario are looked up
+    in a single vectorized pass. Events missing from a scenario have a NaN
+    weight in that scenario.
+    """
+
+    def __init__(self, scenario_event_weights):
+        self.event_ids = np.unique(
+            np.concatenate(
+                [
+                    event_weights.event_ids
+                    for event_weights in scenario_event_weights
+                ]
+            )
+        )
+        self.weights = np.full(
+            (len(self.event_ids), len(scenario_event_weights)), np.nan
+        )
+        for scenario, event_weights in enumerate(scenario_event_weights):
+            positions = np.searchsorted(
+                self.event_ids, event_weights.event_ids
+            )
+            self.weights[positions, scenario] = event_weights.weights
+        self.event_ids.flags.writeable = False
+        self.weights.flags.writeable = False
+
+    @classmethod
+    def from_arrays(cls, event_ids, weights):
+        # Lookup table over arrays of sorted event IDs and their weights,
+        # which aren't copied
+        scenario_weights = cls.__new__(cls)
+        scenario_weights.event_ids = event_ids
+        scenario_weights.weights = weights
+        return scenario_weights
+
+    def lookup(self, event_ids):
+        """
+        Returns a boolean mask of the given event IDs that have a weight in
+        any scenario, and a row of scenario weights per matching event ID.
+        """
+        event_ids = np.asarray(event_ids)
+        if len(self.event_ids) == 0:
+            return np.zeros(len(event_ids), dtype=bool), self.weights
+
+        positions = np.searchsorted(self.event_ids, event_ids)
+        positions[positions == len(self.event_ids)] = 0
+        matches = self.event_ids[positions] == event_ids
+        return matches, self.weights[positions[matches]]
@@ -0,0 +1,264 @@
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from utils.file_handler import find_column
+from utils.loss_data_cache import load_chunk
+from layer_loss_duplicator.event_weights import ScenarioWeights
+
+# Number of processes parsing, filtering, scaling and encoding loss data
+SCALING_PROCESSES = multiprocessing.cpu_count()
+
+# ELT columns holding monetary values, which are scaled by the event weight
+MONETARY_COLUMNS = ["PERSPVALUE", "STDDEVI", "STDDEVC", "EXPVALUE", "LOSS"]
+# ELT columns that sum up when the rows of an event are combined into a
+# single occurrence. Mean losses and exposures add up, and so do the
+# standard deviations of perfectly correlated losses.
+SUMMED_COLUMNS = ["PERSPVALUE", "STDDEVC", "EXPVALUE", "LOSS"]
+# ELT columns that add up in quadrature, the standard deviations of
+# independent losses
+QUADRATURE_COLUMNS = ["STDDEVI"]
+
+# Event weights of all scenarios in the worker processes, mapped from the
+# shared memory of the pool
+_scenario_weights = None
+_shared_memory = []
+
+
+class ScalingPool:
+    """
+    Pool of processes running the CPU-bound stages of loss set
+    transformation: parsing loss data, filtering and scaling it by the
+    event weights and encoding it as CSV. Network stages stay on threads,
+    which submit their work to the pool and wait for it.
+
+    The event weights of all scenarios are copied once into shared memory,
+    which every worker process maps instead of receiving its own copy.
+    """
+
+    def __init__(self, scenario_weights, processes=SCALING_PROCESSES):
+        self.scenario_weights = scenario_weights
+        self.processes = processes
+        # Items submitted to the pool, but not done yet, across all threads
+        self._in_flight = threading.BoundedSemaphore(2 * processes)
+        self._shared_memory = []
+        self._executor = None
+
+    def __enter__(self):
+        specs = [
+            self._share(self.scenario_weights.event_ids),
+            self._share(self.scenario_weights.weights),
+        ]
+        # Spawned processes don't inherit the locks held by other threads
+        self._executor = ProcessPoolExecutor(
+            self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_attach_weights,
+            initargs=specs,
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown()
+        for block in self._shared_memory:
+            block.close()
+            block.unlink()
+        self._shared_memory = []
+
+    def _share(self, array):
+        block = shared_memory.SharedMemory(
+            create=True, size=max(array.nbytes, 1)
+        )
+        self._shared_memory.append(block)
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        return block.name, array.shape, array.dtype.str
+
+    def submit(self, func, *args):
+        self._in_flight.acquire()
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self._in_flight.release())
+        return future
+
+    def map(self, func, items, *args):
+        """
+        Yields func(item, *args) for every item, in order. Items are only
+        taken from the iterable while few enough are in flight, so that
+        memory stays bounded when they are read from a stream.
+        """
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(self.submit(func, item, *args))
+                if len(pending) >= self.processes:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _attach_weights(event_ids_spec, weights_spec):
+    # Runs in every worker process when it starts
+    global _scenario_weights
+
+    arrays = []
+    for name, shape, dtype in (event_ids_spec, weights_spec):
+        block = shared_memory.SharedMemory(name=name)
+        _shared_memory.append(block)
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        array.flags.writeable = False
+        arrays.append(array)
+    _scenario_weights = ScenarioWeights.from_arrays(*arrays)
+
+
+def filter_elt_chunk(source):
+    """
+    Returns the rows of the ELT chunk whose events have a weight in any
+    scenario, and the distinct event IDs of the chunk.
+    """
+    chunk = load_chunk(source)
+    event_ids = chunk[find_column("event", chunk.columns.tolist())]
+    matches, _ = _scenario_weights.lookup(event_ids.to_numpy())
+    return chunk.loc[matches], np.unique(event_ids.to_numpy())
+
+
+def scale_elt(elt_df, scenario_indexes, aggregate_secondary_uncertainty):
+    """
+    Scales the ELT for all the given scenarios at once, returns the scaled
+    ELT of each scenario as CSV.
+    """
+    event_id_column = find_column("event", elt_df.columns.tolist())
+
+    # Only events that occur in the weights tables will remain
+    matches, weights = _scenario_weights.lookup(
+        elt_df[event_id_column].to_numpy()
+    )
+    weights = weights[:, scenario_indexes]
+    weighted_elt_df = elt_df.loc[matches].drop(columns=event_id_column)
+    weighted_elt_df.columns = weighted_elt_df.columns.str.upper()
+
+    # Drop incomplete rows along with their weights
+    complete = weighted_elt_df.notna().all(axis=1).to_numpy()
+    if not complete.all():
+        weighted_elt_df = weighted_elt_df.loc[complete]
+        weights = weights[complete]
+
+    if len(weighted_elt_df.columns) < 4:
+        # ELT without secondary uncertainty (maybe AIR)
+        # Scale mean loss value and set exposure value equal to the scaled
+        # loss
+        scaled_columns = ["LOSS"]
+    else:
+        # ELT with secondary uncertainty (likely RMS)
+        # Scale mean loss value, independent and correlated standard
+        # deviations and exposure value
+        scaled_columns = [
+            column
+            for column in MONETARY_COLUMNS
+            if column in weighted_elt_df.columns
+        ]
+    # Scale the columns for every scenario in one pass, the result is
+    # indexed by scenario, row and column
+    scaled = (
+        weighted_elt_df[scaled_columns].to_numpy(dtype=np.float64)
+        * weights.T[:, :, np.newaxis]
+    )
+
+    scaled_elts = []
+    for scenario, scaled_values in enumerate(scaled):
+        # Events without weight in the scenario are left out
+        weighted = ~np.isnan(weights[:, scenario])
+        scaled_elt_df = weighted_elt_df.loc[weighted].copy()
+        scaled_elt_df[scaled_columns] = scaled_values[weighted]
+        if len(scaled_columns) == 1:
+            scaled_elt_df["STDDEVC"] = 0
+            scaled_elt_df["STDDEVI"] = 0
+            scaled_elt_df["EXPVALUE"] = scaled_elt_df["LOSS"]
+        # Set EventId for all entries to 1
+        # NOTE: The platform will automatically combine multiple entries with the same event ID into a single occurrence.
+        scaled_elt_df["EVENTID"] = 1
+        scaled_elt_df = aggregate_elt(
+            scaled_elt_df,
+            len(scaled_columns) == 1 or aggregate_secondary_uncertainty,
+        )
+        scaled_elts.append(scaled_elt_df.to_csv(index=False))
+    return scaled_elts
+
+
+def aggregate_elt(scaled_elt_df, aggregate):
+    """
+    Combines the rows of the scaled ELT, which all have the same event ID,
+    into the single occurrence the platform would make of them. Without
+    secondary uncertainty the result is exactly the same. With it, the
+    single row only matches the mean and both standard deviations, so it
+    is an approximation that the config has to opt into.
+    """
+    columns = scaled_elt_df.columns.drop("EVENTID")
+    if (
+        not aggregate
+        or len(scaled_elt_df) < 2
+        or not columns.isin(SUMMED_COLUMNS + QUADRATURE_COLUMNS).all()
+    ):
+        return scaled_elt_df
+
+    values = scaled_elt_df[columns].to_numpy(dtype=np.float64)
+    quadrature = columns.isin(QUADRATURE_COLUMNS)
+    aggregated = values.sum(axis=0)
+    aggregated[quadrature] = np.sqrt(
+        np.square(values[:, quadrature]).sum(axis=0)
+    )
+    aggregated_elt_df = pd.DataFrame([aggregated], columns=columns)
+    aggregated_elt_df["EVENTID"] = 1
+    return aggregated_elt_df[scaled_elt_df.columns]
+
+
+def scale_yelt_chunk(source, scenario_indexes):
+    """
+    Scales the losses of the rows of weighted events in the YELT chunk for
+    all the given scenarios at once, and maps their events onto event 1 of
+    the Convolution catalog like scale_elt does. Returns the distinct event IDs of the
+    chunk, the column names and the scaled rows of each scenario as CSV
+    without header.
+    """
+    chunk = load_chunk(source)
+    columns = chunk.columns.tolist()
+    event_id_column = find_column("event", columns)
+    event_ids = chunk[event_id_column].to_numpy()
+    loss_column = find_column("loss", columns).upper()
+
+    matches, weights = _scenario_weights.lookup(event_ids)
+    weighted_yelt_df = chunk.loc[matches]
+    weighted_yelt_df.columns = weighted_yelt_df.columns.str.upper()
+    losses = weighted_yelt_df[loss_column].to_numpy(dtype=np.float64)
+    # Scale the losses for every scenario in one pass
+    scaled = losses * weights[:, scenario_indexes].T
+
+    scaled_yelts = []
+    for scenario_losses in scaled:
+        # Events without weight in the scenario are left out
+        weighted = ~np.isnan(scenario_losses)
+        scaled_yelts.append(
+            weighted_yelt_df.loc[weighted]
+            .assign(
+                **{
+                    loss_column: scenario_losses[weighted],
+                    event_id_column.upper(): 1,
+                }
+            )
+            .to_csv(index=False, header=False)
+        )
+    return (
+        np.unique(event_ids),
+        weighted_yelt_df.columns.tolist(),
+        scaled_yelts,
+    )
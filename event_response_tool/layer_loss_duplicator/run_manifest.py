@@ -0,0 +1,186 @@
+import os
+import glob
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+from utils.alert import Alert as alert
+
+MANIFEST_FILE = "manifest.json"
+# Event IDs of every source loss set, kept apart from the JSON manifest as
+# they can be very numerous
+LOSS_SET_EVENTS_FILE = "loss_set_events.npz"
+
+
+def _weights_at(event_ids, weights, query):
+    # Weights of the queried event IDs, NaN for events without a weight
+    positions = np.searchsorted(event_ids, query)
+    positions[positions == len(event_ids)] = 0
+    found = np.zeros(len(query), dtype=bool)
+    if len(event_ids):
+        found = event_ids[positions] == query
+    result = np.full(len(query), np.nan)
+    result[found] = weights[positions[found]]
+    return result
+
+
+class RunManifest:
+    """
+    Record of an event response run, written into its archive directory.
+
+    The manifest holds a hash of the event weights, the weight of every
+    event, the scaling settings, and for every source loss set its
+    modification stamp, its event IDs and the scaled loss set that was
+    uploaded for it. An incremental run compares its weights with those of
+    the previous manifest and only scales again the loss sets that contain
+    an event whose weight changed.
+    """
+
+    def __init__(
+        self,
+        event_weights,
+        analysis_profile_uuid,
+        aggregate_secondary_uncertainty=False,
+    ):
+        self.event_weights = event_weights
+        self.analysis_profile_uuid = analysis_profile_uuid
+        self.aggregate_secondary_uncertainty = aggregate_secondary_uncertainty
+        # Source LossSet UUID : modification stamp and scaled LossSet UUID
+        self.loss_sets = {}
+        # Source LossSet UUID : sorted event IDs of the source ELT
+        self.loss_set_events = {}
+        self.layer_views = {}  # Old LayerView UUID : New LayerView UUID
+        self._lock = threading.Lock()
+
+    @property
+    def weights_hash(self):
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(self.event_weights.event_ids))
+        digest.update(np.ascontiguousarray(self.event_weights.weights))
+        return digest.hexdigest()
+
+    @staticmethod
+    def loss_set_stamp(loss_set):
+        stamp = getattr(loss_set, "modified", None) or getattr(
+            loss_set, "created", None
+        )
+        return None if stamp is None else str(stamp)
+
+    def record_loss_set(self, loss_set, event_ids, scaled_loss_set):
+        with self._lock:
+            self.loss_sets[loss_set.id] = {
+                "modified": self.loss_set_stamp(loss_set),
+                "scaled_loss_set": scaled_loss_set.id,
+            }
+            self.loss_set_events[loss_set.id] = np.unique(event_ids)
+
+    def merge(self, previous):
+        # Takes over the records of a previous run, the records of this run
+        # take precedence
+        with self._lock:
+            self.loss_sets = {**previous.loss_sets, **self.loss_sets}
+            self.loss_set_events = {
+                **previous.loss_set_events,
+                **self.loss_set_events,
+            }
+            self.layer_views = {**previous.layer_views, **self.layer_views}
+
+    def record_layer_view(self, old_layer_view_uuid, new_layer_view_uuid):
+        with self._lock:
+            self.layer_views[old_layer_view_uuid] = new_layer_view_uuid
+
+    def write(self, directory):
+        manifest = {
+            "analysis_profile_uuid": self.analysis_profile_uuid,
+            "aggregate_secondary_uncertainty": (
+                self.aggregate_secondary_uncertainty
+            ),
+            "event_weights_hash": self.weights_hash,
+            "event_weights": {
+                "event_ids": self.event_weights.event_ids.tolist(),
+                "weights": self.event_weights.weights.tolist(),
+            },
+            "loss_sets": self.loss_sets,
+            "layer_views": self.layer_views,
+        }
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE), "w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            np.savez_compressed(
+                os.path.join(directory, LOSS_SET_EVENTS_FILE),
+                **self.loss_set_events,
+            )
+        except OSError as e:
+            alert.warning(f"Unable to write the run manifest: {e}")
+
+    def changed_events(self, previous):
+        """
+        Returns the IDs of the events whose weight differs from the
+        previous run, including events that were added or removed.
+        """
+        previous_ids = np.asarray(previous.event_weights["event_ids"])
+        previous_weights = np.asarray(
+            previous.event_weights["weights"], dtype=np.float64
+        )
+        event_ids = np.union1d(self.event_weights.event_ids, previous_ids)
+        current = _weights_at(
+            self.event_weights.event_ids,
+            self.event_weights.weights,
+            event_ids,
+        )
+        before = _weights_at(previous_ids, previous_weights, event_ids)
+        return event_ids[current != before]
+
+
+class PreviousRun:
+    """
+    Manifest of an earlier run, loaded from its archive directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.analysis_profile_uuid = manifest["analysis_profile_uuid"]
+        # None for manifests written before the setting was recorded
+        self.aggregate_secondary_uncertainty = manifest.get(
+            "aggregate_secondary_uncertainty"
+        )
+        self.event_weights_hash = manifest["event_weights_hash"]
+        self.event_weights = manifest["event_weights"]
+        self.loss_sets = manifest["loss_sets"]
+        self.layer_views = manifest["layer_views"]
+        with np.load(os.path.join(directory, LOSS_SET_EVENTS_FILE)) as f:
+            self.loss_set_events = {name: f[name] for name in f.files}
+
+    @classmethod
+    def load(cls, directory):
+        # Returns None when the run has no readable manifest
+        try:
+            return cls(directory)
+        except (OSError, ValueError, KeyError) as e:
+            alert.warning(f"Ignoring run manifest in {directory}: {e}")
+            return None
+
+    @classmethod
+    def find_latest(cls, archive_dir, exclude=None, scenario=None):
+        # The most recent run in the archive that wrote a manifest, for the
+        # given scenario of multi-scenario runs
+        manifests = []
+        for run_dir in glob.glob(
+            os.path.join(archive_dir, "event_response-*")
+        ):
+            if exclude is not None and os.path.normpath(
+                run_dir
+            ) == os.path.normpath(exclude):
+                continue
+            if scenario is not None:
+                run_dir = os.path.join(run_dir, scenario)
+            if os.path.isfile(os.path.join(run_dir, MANIFEST_FILE)):
+                manifests.append(os.path.join(run_dir, MANIFEST_FILE))
+        if not manifests:
+            return None
+        latest = max(manifests, key=os.path.getmtime)
+        return cls.load(os.path.dirname(latest))
@@ -0,0 +1,108 @@
+import numpy as np
+import analyzere
+
+from utils.alert import Alert as alert
+from layer_loss_duplicator.run_manifest import RunManifest
+
+
+class Scenario:
+    """
+    One set of event weights applied to the layers, together with the
+    record of the loss sets scaled for it in this run.
+
+    When given the previous run of the scenario, the scaled loss sets of
+    that run are reused for source loss sets none of whose events changed
+    weight. When resuming that run, its records are also carried over into
+    the manifest of this run, which then covers all the layers.
+    """
+
+    def __init__(
+        self,
+        name,
+        event_weights,
+        analysis_profile_uuid,
+        output_dir,
+        previous_run=None,
+        aggregate_secondary_uncertainty=False,
+        resumed=False,
+    ):
+        self.name = name
+        self.event_weights = event_weights
+        self.output_dir = output_dir
+        self.manifest = RunManifest(
+            event_weights,
+            analysis_profile_uuid,
+            aggregate_secondary_uncertainty,
+        )
+        self.loss_set_mapping = {}  # Old LossSet UUID : New LossSet UUID
+
+        self.previous_run = None
+        if previous_run is not None:
+            if previous_run.analysis_profile_uuid != analysis_profile_uuid:
+                alert.warning(
+                    f"Previous run in {previous_run.directory} used another Analysis Profile, processing all loss sets"
+                )
+            elif (
+                previous_run.aggregate_secondary_uncertainty
+                != aggregate_secondary_uncertainty
+            ):
+                alert.warning(
+                    f"Previous run in {previous_run.directory} used another aggregate_secondary_uncertainty setting, processing all loss sets"
+                )
+            else:
+                self.previous_run = previous_run
+                self.changed_events = self.manifest.changed_events(
+                    previous_run
+                )
+                alert.info(
+                    f"{len(self.changed_events)} events changed weight since the run in {previous_run.directory}"
+                )
+                # Only a run with the same weights can stand in for the
+                # resumed one
+                if resumed and not len(self.changed_events):
+                    self.manifest.merge(previous_run)
+                elif resumed:
+                    alert.warning(
+                        f"Event weights differ from the resumed run in {previous_run.directory}, its records are not carried over"
+                    )
+
+    def record_loss_set(self, loss_set, event_ids, scaled_loss_set):
+        self.manifest.record_loss_set(loss_set, event_ids, scaled_loss_set)
+        self.loss_set_mapping[loss_set.id] = scaled_loss_set.id
+
+    def reuse_loss_set(self, loss_set):
+        # Returns the scaled loss set of the previous run if the source loss
+        # set didn't change and none of its events changed weight
+        if self.previous_run is None:
+            return None
+        previous = self.previous_run.loss_sets.get(loss_set.id)
+        event_ids = self.previous_run.loss_set_events.get(loss_set.id)
+        stamp = RunManifest.loss_set_stamp(loss_set)
+        if (
+            previous is None
+            or event_ids is None
+            or stamp is None
+            or previous["modified"] != stamp
+            or np.isin(event_ids, self.changed_events).any()
+        ):
+            return None
+
+        # Ask the server, the scaled loss set may have been deleted since
+        # the previous run. The resource cache would still return it.
+        try:
+            scaled_loss_set = analyzere.LossSet.retrieve(
+                previous["scaled_loss_set"]
+            )
+        except Exception as e:
+            alert.debug(
+                f"Unable to reuse LossSet {previous['scaled_loss_set']}: {e}"
+            )
+            return None
+        if scaled_loss_set.status != "processing_succeeded":
+            return None
+
+        alert.debug(
+            f"Reusing LossSet {scaled_loss_set.id} for loss_set {loss_set.id}"
+        )
+        self.record_loss_set(loss_set, event_ids, scaled_loss_set)
+        return scaled_loss_set
@@ -1,8 +1,240 @@
-def check_resource_upload_status(are_resource):
-    while True:
-        are_resource.reload()
-        if are_resource.status in [
-            "processing_failed",
-            "processing_succeeded",
-        ]:
-            break
+import time
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from six.moves.urllib.parse import urljoin
+
+import analyzere
+from analyzere.requestor import handle_api_error
+
+from utils import http_session
+
+logger = logging.getLogger()
+
+FINAL_STATUSES = ["processing_failed", "processing_succeeded"]
+
+# Polling defaults: resources are first checked after INITIAL_INTERVAL
+# seconds, the interval then doubles up to MAX_INTERVAL until the resource
+# finished processing or TIMEOUT seconds have passed.
+INITIAL_INTERVAL = 0.5
+MAX_INTERVAL = 30.0
+TIMEOUT = 4 * 60 * 60
+# Upper bound on the total number of status requests sent per second and
+# on the number of resources retrieved per request
+MAX_REQUESTS_PER_SECOND = 5.0
+PAGE_SIZE = 100
+
+
+class _PendingResource:
+    def __init__(self, resource, timeout):
+        now = time.monotonic()
+        self.resource = resource
+        self.future = Future()
+        self.interval = INITIAL_INTERVAL
+        self.next_poll = now + self.interval
+        self.deadline = now + timeout
+
+    def backoff(self, now):
+        self.interval = min(self.interval * 2, MAX_INTERVAL)
+        self.next_poll = now + self.interval
+
+
+def _fail(pending_resources, error):
+    for pending in pending_resources:
+        if not pending.future.done():
+            pending.future.set_exception(error)
+
+
+class StatusPoller:
+    """
+    Waits for Analyze Re resources to finish processing on a single
+    background thread.
+
+    Callers register resources and receive a future that resolves to the
+    resource, reloaded in place, once its status is final. Resources that
+    are due are polled together, one list request per resource type and
+    page of IDs, and every resource is polled with exponential backoff
+    until its deadline. The total request rate is capped across all
+    registered resources.
+    """
+
+    def __init__(
+        self,
+        max_requests_per_second=MAX_REQUESTS_PER_SECOND,
+        page_size=PAGE_SIZE,
+    ):
+        self.min_request_interval = 1.0 / max_requests_per_second
+        self.page_size = page_size
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._last_request = 0.0
+
+    def register(self, are_resource, timeout=TIMEOUT):
+        pending = _PendingResource(are_resource, timeout)
+        with self._condition:
+            self._pending.append(pending)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="status-poller", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+        return pending.future
+
+    def _throttle(self):
+        wait = self._last_request + self.min_request_interval
+        now = time.monotonic()
+        if wait > now:
+            time.sleep(wait - now)
+        self._last_request = time.monotonic()
+
+    def _poll(self, due):
+        # Group the due resources by type so that each type can be listed
+        # with a single request per page of IDs.
+        by_type = {}
+        for pending in due:
+            by_type.setdefault(type(pending.resource), []).append(pending)
+
+        for resource_type, group in by_type.items():
+            for start in range(0, len(group), self.page_size):
+                page = group[start : start + self.page_size]
+                self._throttle()
+                try:
+                    self._poll_page(resource_type, page)
+                except Exception as e:
+                    # Only the resources of this page are failed, the
+                    # poller keeps serving the others
+                    _fail(page, e)
+
+    def _poll_page(self, resource_type, page):
+        listed = resource_type.list(
+            ids=",".join(p.resource.id for p in page),
+            limit=len(page),
+        )
+
+        current = {resource.id: resource for resource in listed}
+        now = time.monotonic()
+        for pending in page:
+            if pending.future.done():
+                # Cancelled by the caller in the meantime
+                continue
+            resource = current.get(pending.resource.id)
+            if resource is not None:
+                pending.resource.clear()
+                pending.resource.update(resource)
+            if getattr(pending.resource, "status", None) in FINAL_STATUSES:
+                pending.future.set_result(pending.resource)
+            elif now >= pending.deadline:
+                pending.future.set_exception(
+                    TimeoutError(
+                        f"{resource_type.__name__} "
+                        f"{pending.resource.id} did not finish "
+                        f"processing in time"
+                    )
+                )
+            else:
+                pending.backoff(now)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._pending = [
+                    p for p in self._pending if not p.future.done()
+                ]
+                now = time.monotonic()
+                due = [p for p in self._pending if p.next_poll <= now]
+                if not due:
+                    next_poll = min(
+                        (p.next_poll for p in self._pending), default=None
+                    )
+                    self._condition.wait(
+                        None if next_poll is None else next_poll - now
+                    )
+                    continue
+
+            logger.debug(f"Polling status of {len(due)} resources")
+            try:
+                self._poll(due)
+            except Exception as e:
+                # This thread alone enforces the deadlines, if it can't go
+                # on nobody would ever resolve the pending futures
+                logger.exception(f"Status poller failed: {e}")
+                with self._condition:
+                    _fail(self._pending, e)
+                    self._pending = []
+                    self._thread = None
+                return
+
+
+status_poller = StatusPoller()
+
+
+def check_resource_upload_status(are_resource, timeout=TIMEOUT):
+    # Returns a future that the shared poller resolves once the resource
+    # finished processing. The resource is reloaded in place.
+    return status_poller.register(are_resource, timeout)
+
+
+def then(future, func):
+    # Returns a future of func applied to the result of future. func runs
+    # on the thread completing future, so it must not block.
+    chained = Future()
+
+    def done(completed):
+        try:
+            chained.set_result(func(completed.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def list_resources(resource_class, ids, page_size=PAGE_SIZE, max_workers=4):
+    # Fetch many resources of one type with paged list requests instead of
+    # one request per resource. IDs unknown to the server are left out.
+    ids = list(dict.fromkeys(ids))
+    pages = [ids[i : i + page_size] for i in range(0, len(ids), page_size)]
+
+    def list_page(page):
+        return resource_class.list(ids=",".join(page), limit=len(page))
+
+    resources = {}
+    with ThreadPoolExecutor(max_workers) as executor:
+        for listed in executor.map(list_page, pages):
+            resources.update((resource.id, resource) for resource in listed)
+    return resources
+
+
+@contextmanager
+def stream_resource_data(are_resource):
+    # Stream the data of a resource instead of loading it into memory at
+    # once like download_data() does. Yields a file-like object.
+    kwargs = {
+        "headers": {"user-agent": analyzere.user_agent},
+        "verify": analyzere.tls_verify,
+        "stream": True,
+    }
+    if analyzere.username and analyzere.password:
+        kwargs["auth"] = (analyzere.username, analyzere.password)
+    url = urljoin(analyzere.base_url, are_resource._data_path)
+
+    resp = http_session.request("get", url, **kwargs)
+    # Retry while the server asks us to, like the analyzere bindings do
+    retry_after = resp.headers.get("Retry-After")
+    while resp.status_code == 503 and retry_after:
+        resp.close()
+        time.sleep(float(retry_after))
+        resp = http_session.request("get", url, **kwargs)
+        retry_after = resp.headers.get("Retry-After")
+
+    try:
+        if not 200 <= resp.status_code < 300:
+            handle_api_error(resp, resp.status_code)
+        resp.raw.decode_content = True
+        yield resp.raw
+    finally:
+        resp.close()
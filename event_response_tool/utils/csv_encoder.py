@@ -0,0 +1,132 @@
+# The tools are installed separately, so
+# batch_upload/uploaders/csv_encoder.py is a copy of this encoder
+# that has to be kept in sync with it.
+import numpy as np
+
+# ASCII codes used when assembling CSV rows. A zero byte marks a padding
+# position in the character matrices that is dropped from the output.
+PAD = 0
+MINUS = ord("-")
+DOT = ord(".")
+COMMA = ord(",")
+NEWLINE = ord("\n")
+ZERO = ord("0")
+
+# Largest magnitude whose scaled value is still exact. Values are scaled
+# in float64, which only holds integers up to 2**53 exactly.
+MAX_SCALED = 2**53
+
+
+def _constant(count, char):
+    return np.full((count, 1), char, dtype=np.uint8)
+
+
+def _digits(magnitude, min_width=1):
+    """
+    Returns a matrix with one row per value holding the right-aligned ASCII
+    digits of the non-negative integers in magnitude. Leading zeros beyond
+    min_width are replaced by padding.
+    """
+    largest = int(magnitude.max()) if len(magnitude) else 0
+    width = max(len(str(largest)), min_width)
+
+    digits = np.empty((len(magnitude), width), dtype=np.uint8)
+    remainder = magnitude.copy()
+    for position in range(width - 1, -1, -1):
+        digits[:, position] = remainder % 10 + ZERO
+        remainder //= 10
+
+    if width > min_width:
+        # Determine the number of significant digits of every value and
+        # blank out the leading zeros.
+        significant = np.full(len(magnitude), min_width)
+        for exponent in range(min_width, width):
+            significant += magnitude >= 10**exponent
+        leading = np.arange(width) < (width - significant)[:, np.newaxis]
+        digits[leading] = PAD
+
+    return digits
+
+
+def _sign(negative):
+    return np.where(negative, MINUS, PAD).astype(np.uint8)[:, np.newaxis]
+
+
+def _encode_integers(values):
+    magnitude = np.abs(values.astype(np.int64)).astype(np.uint64)
+    return np.hstack([_sign(values < 0), _digits(magnitude)])
+
+
+def _encode_fixed(values, precision):
+    scale = 10**precision
+    scaled = np.rint(np.abs(values) * scale).astype(np.uint64)
+    # Values that round to zero are written without a sign
+    negative = (values < 0) & (scaled > 0)
+    whole = _digits(scaled // scale)
+    if precision == 0:
+        return np.hstack([_sign(negative), whole])
+
+    fraction = _digits(scaled % scale, min_width=precision)
+    return np.hstack(
+        [_sign(negative), whole, _constant(len(values), DOT), fraction]
+    )
+
+
+def _encode_shortest(values):
+    # NumPy renders floats with the shortest representation that round
+    # trips, the same output as repr() and DataFrame.to_csv.
+    text = values.astype(np.bytes_)
+    return text.view(np.uint8).reshape(len(values), text.itemsize)
+
+
+def encode_column(values, precision=None):
+    """
+    Returns the ASCII character matrix for a numeric column. Floating point
+    columns are rounded to the given number of decimals, or written with
+    full precision if no precision is given.
+    """
+    if values.dtype.kind in "biu":
+        return _encode_integers(values)
+
+    if precision is not None and len(values):
+        magnitude = np.abs(values).max()
+        if (
+            np.isfinite(magnitude)
+            and magnitude * 10**precision < MAX_SCALED
+        ):
+            return _encode_fixed(values, precision)
+        # Fall back to formatting each value individually if the scaled
+        # values would lose digits in float64.
+        # Values that round to zero are written without a sign
+        values = np.where(np.round(values, precision) == 0, 0.0, values)
+        text = np.char.mod(f"%.{precision}f", values).astype(np.bytes_)
+        return text.view(np.uint8).reshape(len(values), text.itemsize)
+
+    return _encode_shortest(values)
+
+
+def encode_csv(columns, precision=None, header=True):
+    """
+    Encodes an ordered dictionary of column name to NumPy array into CSV
+    bytes, preceded by a header row unless header is False.
+
+    Every column is turned into a fixed width character matrix in a single
+    vectorized pass. The matrices are laid out side by side with separator
+    columns and the padding is dropped, which yields the CSV rows in order.
+    """
+    precision = precision or {}
+    header = (",".join(columns) + "\n").encode() if header else b""
+
+    count = len(next(iter(columns.values()), []))
+    if count == 0:
+        return header
+
+    parts = []
+    for name, values in columns.items():
+        if parts:
+            parts.append(_constant(count, COMMA))
+        parts.append(encode_column(values, precision.get(name)))
+    parts.append(_constant(count, NEWLINE))
+
+    rows = np.hstack(parts)
+    return header + rows[rows != PAD].tobytes()
@@ -3,6 +3,8 @@ import logging
 import pandas as pd
 import io
 import re
+import queue
+import threading
 
 from utils.alert import Alert as alert
 
@@ -65,3 +67,87 @@ def write_output_file(output_data, column_names_list, file_name, file_path):
 
 def join(df_1, df_2, how="inner", on=None):
     return pd.merge(df_1, df_2, how=how, on=on)
+
+
+class ChunkedByteStream:
+    """
+    Read-only file-like object over an iterable of byte chunks.
+
+    Chunks are produced on a background thread while the stream is being
+    read, so that generating data overlaps with uploading it. At most
+    `prefetch` chunks are buffered ahead of the reader, which keeps memory
+    bounded regardless of the total size of the data. The thread starts
+    with the first read and stops once the stream is closed, which the
+    reader must do when it gives up early.
+    """
+
+    def __init__(self, chunks, prefetch=2):
+        self._chunks = chunks
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._buffer = bytearray()
+        self._exhausted = False
+        self._closed = threading.Event()
+        self._producer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _put(self, item):
+        # Waits for room in the queue unless the stream is closed, returns
+        # whether the item was queued
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for chunk in self._chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(None)
+
+    def close(self):
+        self._closed.set()
+        if self._producer is not None:
+            self._producer.join()
+            self._producer = None
+        self._buffer = bytearray()
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed stream")
+        if self._producer is None and not self._exhausted:
+            self._producer = threading.Thread(
+                target=self._produce, daemon=True
+            )
+            self._producer.start()
+
+        while not self._exhausted and (size < 0 or len(self._buffer) < size):
+            chunk = self._queue.get()
+            if chunk is None:
+                self._exhausted = True
+            elif isinstance(chunk, Exception):
+                self._exhausted = True
+                raise chunk
+            else:
+                self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
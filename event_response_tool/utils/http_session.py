@@ -0,0 +1,110 @@
+import socket
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from analyzere import requestor
+
+logger = logging.getLogger()
+
+# Number of connections kept open to the server. It should be at least the
+# number of threads sending requests at the same time.
+POOL_MAXSIZE = 32
+
+# Keep idle connections alive through firewalls and load balancers, and
+# send small requests without delay
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+]
+for option, value in [("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15)]:
+    if hasattr(socket, option):
+        SOCKET_OPTIONS.append(
+            (socket.IPPROTO_TCP, getattr(socket, option), value)
+        )
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTP adapter whose connection pool keeps connections alive at TCP
+    level and reports how often pooled connections were reused.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+    def statistics(self):
+        sent = opened = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return sent, opened
+
+
+class _SessionRequests:
+    # Stands in for the requests module in analyzere versions that send
+    # every request with requests.request(), which opens a new connection
+    # per request.
+    def __init__(self, session):
+        self._session = session
+
+    def request(self, method, url, **kwargs):
+        return self._session.request(method, url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+_session = None
+_adapter = None
+
+
+def configure_session(pool_maxsize=POOL_MAXSIZE):
+    """
+    Makes the analyzere bindings send all requests through one pooled
+    keep-alive session sized for pool_maxsize concurrent requests.
+    """
+    global _session, _adapter
+
+    _adapter = KeepAliveAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    _session = requests.Session()
+    _session.mount("https://", _adapter)
+    _session.mount("http://", _adapter)
+
+    if hasattr(requestor, "session"):
+        requestor.session = _session
+    else:
+        requestor.requests = _SessionRequests(_session)
+    logger.debug(f"Configured HTTP connection pool of {pool_maxsize}")
+    return _session
+
+
+def request(method, url, **kwargs):
+    # Send a request through the pooled session if it has been configured
+    if _session is None:
+        return requests.request(method, url, **kwargs)
+    return _session.request(method, url, **kwargs)
+
+
+def pool_statistics():
+    """
+    Returns the number of requests sent through the pooled session, the
+    number that reused a pooled connection (hits) and the number that had
+    to open a new connection (misses).
+    """
+    sent, opened = _adapter.statistics() if _adapter else (0, 0)
+    return {"requests": sent, "hits": sent - opened, "misses": opened}
+
+
+def log_pool_statistics():
+    statistics = pool_statistics()
+    logger.info(
+        f"HTTP connection pool: {statistics['requests']} requests, "
+        f"{statistics['hits']} reused connections, "
+        f"{statistics['misses']} new connections"
+    )
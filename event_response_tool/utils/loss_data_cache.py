@@ -0,0 +1,221 @@
+import io
+import os
+import shutil
+import hashlib
+import threading
+import logging
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import analyzere
+
+from utils.are_resources import stream_resource_data
+
+logger = logging.getLogger()
+
+# Number of bytes of CSV data parsed, and cached, at once
+CHUNK_BYTES = 32 * 1024**2
+
+# Source of a chunk of loss data, either a block of CSV data starting with
+# the header line, which is cached to cache_path once parsed if given, or
+# the path of a cached chunk
+ChunkSource = namedtuple("ChunkSource", ["data", "path", "cache_path"])
+
+
+def load_chunk(source):
+    """
+    Returns the chunk of loss data of the source as a DataFrame with lower
+    case column names. Chunks of numeric data are cached if requested.
+    """
+    if source.data is None:
+        with np.load(source.path) as columns:
+            return pd.DataFrame({c: columns[c] for c in columns.files})
+
+    chunk = pd.read_csv(io.BytesIO(source.data))
+    if chunk.empty:
+        # Loss data without rows, whose columns would be parsed as text
+        chunk = chunk.astype(np.int64)
+    chunk.columns = chunk.columns.str.lower()
+    if source.cache_path and all(
+        dtype.kind in "biuf" for dtype in chunk.dtypes
+    ):
+        np.savez(
+            source.cache_path,
+            **{column: chunk[column].to_numpy() for column in chunk.columns},
+        )
+    return chunk
+
+
+class LossDataCache:
+    """
+    On-disk cache of the data of Analyze Re loss sets.
+
+    The data is stored per loss set and modification stamp, so a loss set
+    whose data changes is downloaded again. Every entry is a directory of
+    NumPy archives, one per chunk of rows with one array per column, which
+    are much smaller and faster to load than the CSV served by the API.
+    When the cache grows beyond its size cap, the least recently used
+    entries are evicted. Without a directory, loss set data is streamed
+    from the server on every call.
+    """
+
+    def __init__(self, directory=None, max_size=10 * 1024**3):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def configure(self, directory=None, max_size_mb=None):
+        self.directory = directory or None
+        if max_size_mb is not None:
+            self.max_size = int(float(max_size_mb) * 1024**2)
+
+    def _server_dir(self):
+        # Keep data of different servers apart
+        server = hashlib.sha1(analyzere.base_url.encode()).hexdigest()[:12]
+        return os.path.join(self.directory, server)
+
+    def _entry_dir(self, loss_set):
+        stamp = getattr(loss_set, "modified", None) or getattr(
+            loss_set, "created", None
+        )
+        if not self.directory or stamp is None:
+            return None
+        stamp = hashlib.sha1(str(stamp).encode()).hexdigest()[:12]
+        return os.path.join(self._server_dir(), f"{loss_set.id}-{stamp}")
+
+    @contextmanager
+    def chunk_sources(self, loss_set):
+        """
+        Yields an iterator over the sources of the chunks of the loss set,
+        which load_chunk turns into DataFrames. Sources can be loaded in
+        other processes, the chunks they cache are only kept once all the
+        sources have been loaded when the context exits.
+        """
+        entry_dir = self._entry_dir(loss_set)
+        if entry_dir and os.path.isdir(entry_dir):
+            logger.debug(f"Loading LossSet {loss_set.id} from disk cache")
+            # Mark the entry as recently used
+            os.utime(entry_dir)
+            yield (
+                ChunkSource(None, os.path.join(entry_dir, name), None)
+                for name in sorted(os.listdir(entry_dir))
+            )
+            return
+
+        with stream_resource_data(loss_set) as data:
+            blocks = self._read_blocks(data)
+            temp_dir = self._temp_dir(loss_set, entry_dir)
+            if not temp_dir:
+                yield (ChunkSource(block, None, None) for block in blocks)
+                return
+
+            chunk_paths = []
+            try:
+                yield self._cache_sources(blocks, temp_dir, chunk_paths)
+            except BaseException:
+                # Never keep partially downloaded data
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+
+            if chunk_paths[-1:] != [None] or not all(
+                map(os.path.isfile, chunk_paths[:-1])
+            ):
+                logger.warning(
+                    f"Unable to cache LossSet {loss_set.id}, "
+                    f"non-numeric or incomplete data"
+                )
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            else:
+                self._store_entry(loss_set, temp_dir, entry_dir)
+
+    def _read_blocks(self, data):
+        # Split the CSV data into blocks of whole lines, each starting with
+        # the header line. Data without rows yields the header alone, so
+        # that its columns are known.
+        header = data.readline()
+        remainder = b""
+        empty = True
+        while True:
+            block = data.read(CHUNK_BYTES)
+            if not block:
+                break
+            block = remainder + block
+            end = block.rfind(b"\n") + 1
+            remainder = block[end:]
+            if end:
+                empty = False
+                yield header + block[:end]
+        if remainder.strip():
+            yield header + remainder
+        elif empty and header.strip():
+            yield header
+
+    def _cache_sources(self, blocks, temp_dir, chunk_paths):
+        # Sources of the blocks, cached into temp_dir. The cache paths are
+        # added to chunk_paths, followed by None once all blocks were read.
+        for index, block in enumerate(blocks):
+            chunk_paths.append(
+                os.path.join(temp_dir, f"chunk-{index:05d}.npz")
+            )
+            yield ChunkSource(block, None, chunk_paths[-1])
+        chunk_paths.append(None)
+
+    def _temp_dir(self, loss_set, entry_dir):
+        # Chunks are cached into a temporary directory, the entry only
+        # becomes visible once all the data has been written
+        if not entry_dir:
+            return None
+        temp_dir = f"{entry_dir}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(temp_dir, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Unable to cache LossSet {loss_set.id}: {e}")
+            return None
+        return temp_dir
+
+    def _store_entry(self, loss_set, temp_dir, entry_dir):
+        with self._lock:
+            try:
+                # Data of older versions of the loss set is never used again
+                server_dir = os.path.dirname(entry_dir)
+                for name in os.listdir(server_dir):
+                    if name.startswith(f"{loss_set.id}-") and not (
+                        name.endswith(".tmp")
+                    ):
+                        shutil.rmtree(
+                            os.path.join(server_dir, name), ignore_errors=True
+                        )
+                os.replace(temp_dir, entry_dir)
+            except OSError as e:
+                logger.warning(f"Unable to cache LossSet {loss_set.id}: {e}")
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                return
+            self._evict()
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache fits
+        entries = []
+        total_size = 0
+        for root, dirs, _ in os.walk(self.directory):
+            for name in dirs:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                files = [os.path.join(path, f) for f in os.listdir(path)]
+                if any(os.path.isdir(f) for f in files):
+                    continue
+                size = sum(os.path.getsize(f) for f in files)
+                entries.append((os.path.getmtime(path), size, path))
+                total_size += size
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.debug(f"Evicting {path} from the disk cache")
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+
+loss_data_cache = LossDataCache()
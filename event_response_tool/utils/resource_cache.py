@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+
+import analyzere
+from analyzere import utils
+from analyzere.base_resources import convert_to_analyzere_object
+from analyzere.requestor import request_raw
+
+logger = logging.getLogger()
+
+
+class ResourceCache:
+    """
+    Thread-safe cache for Analyze Re resources that don't change once they
+    have been created, like Analysis Profiles, Event Catalogs and FX
+    Profiles.
+
+    Each resource is fetched from the server at most once per run, even if
+    several threads request it at the same time. Every call returns a new
+    resource object, so callers are free to modify what they get. When a
+    cache directory is configured, the server responses are also persisted
+    to disk and reused by later runs until they are older than the TTL.
+    """
+
+    def __init__(self, directory=None, ttl=24 * 60 * 60):
+        self.directory = directory
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def configure(self, directory=None, ttl=None):
+        self.directory = directory or None
+        if ttl is not None:
+            self.ttl = float(ttl)
+
+    def _disk_path(self, collection, id_):
+        # Keep responses of different servers apart
+        server = hashlib.sha1(analyzere.base_url.encode()).hexdigest()[:12]
+        return os.path.join(self.directory, server, collection, f"{id_}.json")
+
+    def _read_disk(self, collection, id_):
+        if not self.directory:
+            return None
+        path = self._disk_path(collection, id_)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as cached_file:
+                return cached_file.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, collection, id_, text):
+        if not self.directory:
+            return
+        path = self._disk_path(collection, id_)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as cached_file:
+                cached_file.write(text)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Unable to cache {collection} {id_}: {e}")
+
+    def _fetch(self, resource_class, id_):
+        collection = resource_class._get_collection_name()
+        text = self._read_disk(collection, id_)
+        if text is None:
+            text = request_raw(
+                "get",
+                resource_class._get_path(id_),
+                headers={"accept": "application/json"},
+            ).text
+            self._write_disk(collection, id_, text)
+        else:
+            logger.debug(f"Loaded {collection} {id_} from disk cache")
+        return json.loads(text, cls=utils.DateTimeDecoder)
+
+    def retrieve(self, resource_class, id_):
+        key = (resource_class._get_collection_name(), id_)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        # Only one thread fetches a given resource, the others wait for it
+        with lock:
+            if key not in self._entries:
+                self._entries[key] = self._fetch(resource_class, id_)
+
+        return convert_to_analyzere_object(self._entries[key], resource_class)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+resource_cache = ResourceCache()
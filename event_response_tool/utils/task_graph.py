@@ -0,0 +1,74 @@
+import logging
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
+
+logger = logging.getLogger()
+
+
+class TaskGraph:
+    """
+    Runs a set of interdependent tasks concurrently.
+
+    Each task is a callable that receives the results of the tasks it
+    depends on as positional arguments, in the order the dependencies were
+    given. A task is started as soon as all of its dependencies have
+    finished, so independent tasks run at the same time. A task may return
+    a future instead of blocking on it, the task then finishes with the
+    result of that future without holding a thread while waiting.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, func, *dependencies):
+        self.tasks[name] = (func, dependencies)
+        return self
+
+    def run(self, max_workers=None):
+        """
+        Runs all tasks and returns a dictionary of task name to result. The
+        first exception raised by any task is re-raised once the running
+        tasks have finished.
+        """
+        for name, (_, dependencies) in self.tasks.items():
+            unknown = [d for d in dependencies if d not in self.tasks]
+            if unknown:
+                raise ValueError(
+                    f"Task {name} depends on unknown tasks {unknown}"
+                )
+
+        results = {}
+        waiting = dict(self.tasks)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers or len(self.tasks)) as executor:
+            while waiting or running:
+                for name, (func, dependencies) in list(waiting.items()):
+                    if all(d in results for d in dependencies):
+                        del waiting[name]
+                        logger.debug(f"Starting task {name}")
+                        future = executor.submit(
+                            func, *[results[d] for d in dependencies]
+                        )
+                        running[future] = name
+
+                if not running:
+                    raise ValueError(
+                        f"Circular dependencies between tasks "
+                        f"{list(waiting)}"
+                    )
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result = future.result()
+                    if isinstance(result, Future):
+                        running[result] = name
+                    else:
+                        results[name] = result
+
+        return results